@@ -0,0 +1,110 @@
+import os
+import json
+
+import numpy as np
+
+# Is* attributes in the order of their bits in flags.npy
+ATTRIBUTES = ['IsOccluded', 'IsTruncated', 'IsGroupOf', 'IsDepiction', 'IsInside']
+
+# Layout of a store directory
+#   meta.json            categories, attribute names and counts
+#   image_ids.npy        sorted image ids, fixed width unicode
+#   image_sizes.npy      int32 (num_images, 2) width and height
+#   offsets.npy          int64 (num_images + 1) annotation rows of image i are offsets[i]:offsets[i + 1]
+#   annotation_ids.npy   int64 coco annotation ids
+#   boxes.npy            float32 (num_annotations, 4) pixel boxes as x, y, width, height
+#   areas.npy            float32 box areas
+#   category_ids.npy     int16 coco category ids
+#   flags.npy            uint8 bit i is set if attribute i is 1
+#   flags_unknown.npy    uint8 bit i is set if attribute i is -1 (not annotated)
+
+
+def pack_flags(attribute_values):
+    # attribute_values: dict attribute name -> int array with values in {-1, 0, 1}
+    num_annotations = len(next(iter(attribute_values.values()))) if attribute_values else 0
+    flags = np.zeros(num_annotations, dtype='uint8')
+    flags_unknown = np.zeros(num_annotations, dtype='uint8')
+    for bit, attribute in enumerate(ATTRIBUTES):
+        if attribute not in attribute_values:
+            continue
+        values = np.asarray(attribute_values[attribute])
+        flags |= (values == 1).astype('uint8') << bit
+        flags_unknown |= (values == -1).astype('uint8') << bit
+    return flags, flags_unknown
+
+def unpack_flags(flags, flags_unknown, attributes=ATTRIBUTES):
+    # inverse of pack_flags, returns dict lower case attribute name -> int8 array
+    unpacked = {}
+    for attribute in attributes:
+        bit = ATTRIBUTES.index(attribute)
+        values = ((flags >> bit) & 1).astype('int8')
+        values[((flags_unknown >> bit) & 1).astype(bool)] = -1
+        unpacked[attribute.lower()] = values
+    return unpacked
+
+
+class AnnotationStore:
+    """
+    Read only access to an annotation store written by utils.write_annotation_store
+    All arrays are memory mapped, so forked dataloader workers share the pages
+    and per image annotations are returned as views without copying
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.categories = self.meta['categories']
+        self.attributes = self.meta['attributes']
+
+        def load(name):
+            return np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+        self.image_ids = load('image_ids')
+        self.image_sizes = load('image_sizes')
+        self.offsets = load('offsets')
+        self.annotation_ids = load('annotation_ids')
+        self.boxes = load('boxes')
+        self.areas = load('areas')
+        self.category_ids = load('category_ids')
+        self.flags = load('flags')
+        self.flags_unknown = load('flags_unknown')
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def index(self, image_id):
+        # position of an image id, image ids are stored sorted
+        position = int(np.searchsorted(self.image_ids, image_id))
+        if position == len(self.image_ids) or self.image_ids[position] != image_id:
+            raise KeyError(image_id)
+        return position
+
+    def __contains__(self, image_id):
+        try:
+            self.index(image_id)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, key):
+        # key is an image id or a position in [0, len(self))
+        position = self.index(key) if isinstance(key, str) else int(key)
+        start, end = int(self.offsets[position]), int(self.offsets[position + 1])
+        width, height = self.image_sizes[position].tolist()
+        return {'image_id': str(self.image_ids[position]),
+                'width': width,
+                'height': height,
+                'ids': self.annotation_ids[start:end],
+                'boxes': self.boxes[start:end],
+                'areas': self.areas[start:end],
+                'category_ids': self.category_ids[start:end],
+                'flags': self.flags[start:end],
+                'flags_unknown': self.flags_unknown[start:end]}
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def unpack_flags(self, annotations):
+        # decode the Is* attributes of annotations returned by __getitem__
+        return unpack_flags(annotations['flags'], annotations['flags_unknown'], self.attributes)
@@ -0,0 +1,380 @@
+import os
+import csv
+import json
+import time
+import utils
+import png_writer
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import warnings
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import skimage.io as io
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the conversion hot paths on synthetic Open Images data')
+    parser.add_argument('--num-images',
+                        dest='num_images',
+                        type=int,
+                        default=10000,
+                        help='number of synthetic images, ids are taken from data/validation_sizes')
+    parser.add_argument('--boxes-per-image',
+                        dest='boxes_per_image',
+                        type=float,
+                        default=8.0,
+                        help='average number of bbox rows per image (train has about 8.4)')
+    parser.add_argument('--labels-per-image',
+                        dest='labels_per_image',
+                        type=float,
+                        default=5.0,
+                        help='average number of image-level label rows per image')
+    parser.add_argument('--mask-images',
+                        dest='mask_images',
+                        type=int,
+                        default=200,
+                        help='number of images with segmentation masks')
+    parser.add_argument('--masks-per-image',
+                        dest='masks_per_image',
+                        type=int,
+                        default=8,
+                        help='maximum number of masks per image')
+    parser.add_argument('--mask-size',
+                        dest='mask_size',
+                        type=int,
+                        nargs=2,
+                        default=[512, 384],
+                        help='width and height of the mask pngs')
+    parser.add_argument('--predictions-per-image',
+                        dest='predictions_per_image',
+                        type=int,
+                        default=100,
+                        help='number of detections per image in the prediction file')
+    parser.add_argument('--filter-images',
+                        dest='filter_images',
+                        type=int,
+                        default=1700000,
+                        help='number of images for the filter_images benchmark (train has about 1.7M)')
+    parser.add_argument('--annotated-fraction',
+                        dest='annotated_fraction',
+                        type=float,
+                        default=0.5,
+                        help='fraction of images that keep an annotation in the filter_images benchmark')
+    parser.add_argument('--csv-workers',
+                        dest='csv_workers',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='number of processes for the parallel csvread_columns benchmark')
+    parser.add_argument('--png-images',
+                        dest='png_images',
+                        type=int,
+                        default=100,
+                        help='number of panoptic pngs written per png writer configuration')
+    parser.add_argument('--png-only',
+                        dest='png_only',
+                        action='store_true',
+                        help='only benchmark the png writers, without synthetic Open Images data')
+    parser.add_argument('--no-memory',
+                        dest='memory',
+                        action='store_false',
+                        help='skip the second run of every benchmark that records peak memory')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='random seed for the synthetic data')
+    parser.add_argument('--workdir',
+                        type=str,
+                        default=None,
+                        help='folder for the synthetic data (default: a temporary folder that is removed)')
+    parser.add_argument('-o', '--output',
+                        type=str,
+                        default='benchmark_results.json',
+                        help='json file for the results')
+    args = parser.parse_args()
+    return args
+
+ATTRIBUTES = ['IsOccluded', 'IsTruncated', 'IsGroupOf', 'IsDepiction', 'IsInside']
+
+def _synthetic_image_ids(num_images, rng):
+    # 16 hex digit ids like the Open Images ImageIDs
+    return ['{:016x}'.format(x) for x in rng.integers(0, 2**63, size=num_images).tolist()]
+
+def _real_image_sizes(num_images):
+    # image ids and sizes of the validation split, extended by derived ids if more are requested
+    sizes = utils.csvread_columns('data/validation_sizes-00000-of-00001.csv')
+    image_ids = sizes['image_id'].tolist()
+    widths = sizes['image_w'].tolist()
+    heights = sizes['image_h'].tolist()
+    for i in range(len(image_ids), num_images):
+        source = i % len(sizes['image_id'])
+        image_ids.append(hashlib.md5('{}-{}'.format(image_ids[source], i).encode('utf-8')).hexdigest()[:16])
+        widths.append(widths[source])
+        heights.append(heights[source])
+    return image_ids[:num_images], widths[:num_images], heights[:num_images]
+
+def _sorted_box(rng, num_rows):
+    low, high = np.sort(rng.random((2, num_rows)), axis=0)
+    return low, high
+
+def make_synthetic_data(args, workdir, rng):
+    """
+    Write synthetic Open Images csv files, mask pngs and a coco style prediction file
+    """
+    annotation_dir = os.path.join(workdir, 'annotations')
+    mask_dir = os.path.join(annotation_dir, 'validation_masks')
+    os.makedirs(mask_dir, exist_ok=True)
+    files = {}
+
+    image_ids, widths, heights = _real_image_sizes(args.num_images)
+    files['sizes'] = os.path.join(workdir, 'sizes.csv')
+    pd.DataFrame({'image_id': image_ids, 'image_w': widths, 'image_h': heights}).to_csv(files['sizes'], index=False)
+
+    categories = ['/m/{:05x}'.format(i) for i in range(601)]
+    files['categories'] = os.path.join(annotation_dir, 'class-descriptions-boxable.csv')
+    pd.DataFrame({'LabelName': categories, 'DisplayName': ['Category {}'.format(i) for i in range(601)]}).to_csv(files['categories'], index=False, header=False)
+
+    licenses = ['https://creativecommons.org/licenses/by/2.0/', 'https://creativecommons.org/licenses/by-nc/2.0/']
+    files['images'] = os.path.join(annotation_dir, 'validation-images-with-rotation.csv')
+    pd.DataFrame({'ImageID': image_ids,
+                  'Subset': 'validation',
+                  'OriginalURL': ['https://farm.staticflickr.com/{}.jpg'.format(image_id) for image_id in image_ids],
+                  'OriginalLandingURL': '',
+                  'License': rng.choice(licenses, size=len(image_ids)),
+                  'AuthorProfileURL': '',
+                  'Author': '',
+                  'Title': 'synthetic, "image"',
+                  'OriginalSize': 0,
+                  'OriginalMD5': '',
+                  'Thumbnail300KURL': '',
+                  'Rotation': 0}).to_csv(files['images'], index=False)
+
+    num_labels = int(args.num_images * args.labels_per_image)
+    files['labels'] = os.path.join(annotation_dir, 'validation-annotations-human-imagelabels-boxable.csv')
+    pd.DataFrame({'ImageID': np.sort(rng.choice(image_ids, size=num_labels)),
+                  'Source': 'verification',
+                  'LabelName': rng.choice(categories, size=num_labels),
+                  'Confidence': rng.integers(0, 2, size=num_labels)}).to_csv(files['labels'], index=False)
+
+    num_boxes = int(args.num_images * args.boxes_per_image)
+    xmin, xmax = _sorted_box(rng, num_boxes)
+    ymin, ymax = _sorted_box(rng, num_boxes)
+    bbox = {'ImageID': np.sort(rng.choice(image_ids, size=num_boxes)),
+            'Source': 'xclick',
+            'LabelName': rng.choice(categories, size=num_boxes),
+            'Confidence': 1,
+            'XMin': xmin.round(6), 'XMax': xmax.round(6), 'YMin': ymin.round(6), 'YMax': ymax.round(6)}
+    for attribute in ATTRIBUTES:
+        bbox[attribute] = rng.integers(-1, 2, size=num_boxes)
+    files['bbox'] = os.path.join(annotation_dir, 'validation-annotations-bbox.csv')
+    pd.DataFrame(bbox).to_csv(files['bbox'], index=False)
+
+    # segmentation rows with one rectangular mask png each, a few masks are empty
+    width, height = args.mask_size
+    rows = []
+    for image_id in image_ids[:args.mask_images]:
+        num_masks = int(rng.integers(1, args.masks_per_image + 1))
+        # every mask lies in its own column band and partly overlaps the next one, so none is hidden
+        band = width // num_masks
+        for j in range(num_masks):
+            label = categories[int(rng.integers(len(categories)))]
+            box_id = '{:08x}'.format(int(rng.integers(2**32)))
+            mask = np.zeros((height, width), dtype='uint8')
+            if rng.random() > 0.02:
+                y0 = int(rng.integers(height // 2))
+                mask[y0:y0 + int(rng.integers(4, height)), j * band:(j + 1) * band + band // 2] = 255
+            name = '{}_{}_{}.png'.format(image_id, label.replace('/', ''), box_id)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                io.imsave(os.path.join(mask_dir, name), mask, check_contrast=False)
+            box = np.sort(rng.random(4).reshape(2, 2), axis=0)
+            rows.append([name, image_id, label, box_id, box[0, 0], box[1, 0], box[0, 1], box[1, 1], 0.9, ''])
+    files['segmentation'] = os.path.join(annotation_dir, 'validation-annotations-object-segmentation.csv')
+    files['mask_dir'] = mask_dir
+    with open(files['segmentation'], 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['MaskPath', 'ImageID', 'LabelName', 'BoxID', 'BoxXMin', 'BoxXMax', 'BoxYMin', 'BoxYMax', 'PredictedIoU', 'Clicks'])
+        writer.writerows(rows)
+
+    num_predictions = args.num_images * args.predictions_per_image
+    boxes = rng.random((num_predictions, 4)) * 400
+    predictions = [{'image_id': image_id, 'category_id': category_id, 'bbox': box, 'score': score}
+                   for image_id, category_id, box, score in zip(np.repeat(image_ids, args.predictions_per_image).tolist(),
+                                                                rng.integers(1, 601, size=num_predictions).tolist(),
+                                                                boxes.round(2).tolist(),
+                                                                rng.random(num_predictions).tolist())]
+    files['predictions'] = os.path.join(workdir, 'predictions.json')
+    with open(files['predictions'], 'w', encoding='utf-8') as f:
+        json.dump(predictions, f)
+
+    return files
+
+def measure(name, rows, function, memory=True):
+    """
+    Time one call of function and optionally record its peak memory in a second call
+    Returns the result of the timed call and a dict with the measurements
+    """
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    result = function()
+    seconds = time.perf_counter() - start_wall
+    cpu_seconds = time.process_time() - start_cpu
+
+    record = {'name': name,
+              'rows': rows,
+              'seconds': round(seconds, 4),
+              'cpu_seconds': round(cpu_seconds, 4),
+              'rows_per_second': round(rows / seconds, 1) if seconds > 0 else None,
+              'peak_memory_mb': None}
+    if memory:
+        # tracemalloc slows python code down, so memory is measured in a separate call
+        # the measured functions keep no caches between calls, so both calls do the same work
+        tracemalloc.start()
+        function()
+        record['peak_memory_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+        tracemalloc.stop()
+    print('{:<40} {:>10} rows {:>9.3f}s {:>12} rows/s {:>10} MiB'.format(
+        name, rows, seconds, str(record['rows_per_second']), str(record['peak_memory_mb'])))
+    return result, record
+
+def benchmark_filter_images(num_images, annotated_fraction, rng, memory=True):
+    image_ids = _synthetic_image_ids(num_images, rng)
+    images = [{'id': image_id} for image_id in image_ids]
+    annotated = rng.random(num_images) < annotated_fraction
+    annotations = [{'image_id': image_id} for image_id, keep in zip(image_ids, annotated.tolist()) if keep]
+
+    filtered_images, record = measure('filter_images', num_images, lambda: utils.filter_images(images, annotations), memory)
+    assert len(filtered_images) == len(annotations)
+    return record
+
+# (backend, level, threaded) combinations measured by benchmark_png_writers
+PNG_WRITER_CONFIGS = [('skimage', None, False),
+                      ('pil', None, False),
+                      ('pil', 1, False),
+                      ('zlib', 1, False),
+                      ('zlib', 3, False),
+                      ('pil', None, True),
+                      ('zlib', 1, True)]
+
+def _synthetic_panoptic_index(shape, rng, num_segments=8):
+    # index image of overlapping rectangles like the combined masks of one image
+    height, width = shape
+    index = np.zeros(shape, dtype='uint8')
+    for segment in range(1, num_segments + 1):
+        y0, x0 = int(rng.integers(height // 2)), int(rng.integers(width // 2))
+        index[y0:y0 + int(rng.integers(4, height)), x0:x0 + int(rng.integers(4, width))] = segment
+    return index
+
+def benchmark_png_writers(num_images, mask_size, rng, memory=True):
+    # id to rgb packing and png encoding of panoptic outputs for every writer configuration
+    width, height = mask_size
+    indices = [_synthetic_panoptic_index((height, width), rng) for _ in range(min(num_images, 16))]
+    segment_ids = [int(segment_id) for segment_id in rng.integers(1, 2**24, size=8)]
+    colors = utils._id_to_rgb(np.array([0] + segment_ids, dtype='uint32'))
+    results = []
+    with tempfile.TemporaryDirectory() as out_dir:
+        for backend, level, threaded in PNG_WRITER_CONFIGS:
+            writer = png_writer.PngWriter(backend, level, threaded=threaded)
+            def write_all():
+                for i in range(num_images):
+                    rgb = np.take(colors, indices[i % len(indices)], axis=0, out=writer.buffer((height, width)))
+                    writer.write(os.path.join(out_dir, '{}.png'.format(i)), rgb)
+                writer.close()
+            name = 'png_writer[{}, level={}{}]'.format(backend, level, ', thread' if threaded else '')
+            _, record = measure(name, num_images, write_all, memory)
+            record['bytes_per_image'] = sum(os.path.getsize(os.path.join(out_dir, file)) for file in os.listdir(out_dir)) // num_images
+            results.append(record)
+    return results
+
+def run_benchmarks(args, files, rng):
+    results = []
+    memory = args.memory
+
+    categories = utils.convert_category_annotations(utils.csvread(files['categories']))
+    licenses = [{'id': 4, 'url': 'http://creativecommons.org/licenses/by/2.0/'},
+                {'id': 2, 'url': 'http://creativecommons.org/licenses/by-nc/2.0/'}]
+
+    # csv loading, the list based reader and the columnar reader
+    num_boxes = int(args.num_images * args.boxes_per_image)
+    rows, record = measure('csvread', num_boxes, lambda: utils.csvread(files['bbox']), memory)
+    results.append(record)
+    _, record = measure('_list_to_dict', num_boxes, lambda: utils._list_to_dict(list(rows)), memory)
+    results.append(record)
+    del rows
+    original_annotations, record = measure('csvread_columns', num_boxes, lambda: utils.csvread_columns(files['bbox']), memory)
+    results.append(record)
+    _, record = measure('csvread_columns[workers={}]'.format(args.csv_workers), num_boxes,
+                        lambda: utils.csvread_columns(files['bbox'], workers=args.csv_workers), memory)
+    results.append(record)
+
+    original_image_metadata = utils.csvread_columns(files['images'], usecols=['ImageID', 'OriginalURL', 'License'])
+    original_image_annotations = utils.csvread_columns(files['labels'], usecols=['ImageID', 'LabelName', 'Confidence'])
+    original_image_sizes = utils.csvread_columns(files['sizes'])
+    images, record = measure('convert_image_annotations', args.num_images,
+                             lambda: utils.convert_image_annotations(original_image_metadata, original_image_annotations, original_image_sizes,
+                                                                     None, categories, licenses, origin_info=True),
+                             memory)
+    results.append(record)
+
+    _, record = measure('convert_instance_annotations', num_boxes,
+                        lambda: utils.convert_instance_annotations(original_annotations, images, categories),
+                        memory)
+    results.append(record)
+
+    original_segmentations = utils.csvread(files['segmentation'])
+    num_segments = len(original_segmentations) - 1
+    with tempfile.TemporaryDirectory() as segmentation_out_dir:
+        _, record = measure('convert_segmentation_annotations', num_segments,
+                            lambda: utils.convert_segmentation_annotations(list(original_segmentations), images, categories,
+                                                                           files['mask_dir'], segmentation_out_dir),
+                            memory)
+    results.append(record)
+
+    with open(files['predictions'], 'r', encoding='utf-8') as f:
+        predictions = json.load(f)
+    image_size_dict = utils.image_sizes_to_dict(original_image_sizes)
+    image_ids = sorted(image_size_dict)
+    _, record = measure('convert_prediction_strings', len(predictions),
+                        lambda: utils.convert_prediction_strings(predictions, image_size_dict, image_ids),
+                        memory)
+    results.append(record)
+
+    results.append(benchmark_filter_images(args.filter_images, args.annotated_fraction, rng, memory))
+    results += benchmark_png_writers(args.png_images, args.mask_size, rng, memory)
+    return results
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(args.seed)
+
+    if args.png_only:
+        results = benchmark_png_writers(args.png_images, args.mask_size, rng, args.memory)
+    else:
+        workdir = args.workdir or tempfile.mkdtemp(prefix='openimages2coco-benchmark-')
+        try:
+            print('writing synthetic data to {}'.format(workdir))
+            files = make_synthetic_data(args, workdir, rng)
+            results = run_benchmarks(args, files, rng)
+        finally:
+            if args.workdir is None:
+                shutil.rmtree(workdir)
+
+    report = {'config': vars(args),
+              'environment': {'python': platform.python_version(),
+                              'numpy': np.__version__,
+                              'pandas': pd.__version__,
+                              'platform': platform.platform(),
+                              'cpu_count': os.cpu_count()},
+              'results': results}
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print('results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
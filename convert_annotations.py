@@ -1,8 +1,10 @@
 import os
-import csv
-import json
 import utils
 import argparse
+import profiler
+import png_writer
+
+from concurrent.futures import ProcessPoolExecutor
 
 def parse_args():
     """
@@ -25,26 +27,84 @@ def parse_args():
                         help='subsets to convert')
     parser.add_argument('--task',
                         type=str,
-                        default='bbox',
+                        nargs='+',
+                        default=['bbox'],
                         choices=['bbox', 'panoptic'],
-                        help='type of annotations')
+                        help='types of annotations, several tasks share the loaded image annotations')
+    parser.add_argument('--compact',
+                        action='store_true',
+                        help='write json without whitespace between items')
+    parser.add_argument('--gzip',
+                        action='store_true',
+                        help='write gzip compressed json (.json.gz)')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='number of processes used to write panoptic masks')
+    parser.add_argument('--png-writer',
+                        dest='png_writer',
+                        type=str,
+                        default='pil',
+                        choices=sorted(png_writer.PNG_WRITERS),
+                        help='backend encoding the panoptic pngs (pil writes the same files as skimage, zlib is a minimal encoder)')
+    parser.add_argument('--png-level',
+                        dest='png_level',
+                        type=int,
+                        default=None,
+                        help='zlib compression level of the panoptic pngs, lower is faster (default: 6 for pil, 1 for zlib)')
+    parser.add_argument('--png-thread',
+                        dest='png_thread',
+                        action='store_true',
+                        help='encode panoptic pngs on a background thread (only used with --workers 1)')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='skip panoptic masks recorded as finished by a previous run')
+    parser.add_argument('--no-cache',
+                        dest='cache',
+                        action='store_false',
+                        help='always parse the csv files instead of using the parsed column cache')
+    parser.add_argument('--csv-workers',
+                        dest='csv_workers',
+                        type=int,
+                        default=1,
+                        help='number of processes parsing chunks of each large csv file')
+    parser.add_argument('--subset-workers',
+                        dest='subset_workers',
+                        type=int,
+                        default=1,
+                        help='number of subsets converted concurrently in separate processes')
+    parser.add_argument('--shard-size',
+                        dest='shard_size',
+                        type=int,
+                        default=0,
+                        help='write json shards of this many images plus an index file instead of a single file')
+    parser.add_argument('--store',
+                        action='store_true',
+                        help='also write bbox annotations into a memory mappable columnar store')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='record wall time, cpu time, peak rss and rows/s of every conversion stage')
+    parser.add_argument('--profile-output',
+                        dest='profile_output',
+                        type=str,
+                        default='profile_report.json',
+                        help='json file for the --profile report')
+    parser.add_argument('--cprofile',
+                        type=str,
+                        nargs='+',
+                        default=[],
+                        help='stages to run under cProfile with --profile, e.g. images annotations:bbox json:bbox')
     args = parser.parse_args()
     return args
 
-args = parse_args()
-base_dir = args.path
-if not isinstance(args.subsets, list):
-    args.subsets = [args.subsets]
-
-for subset in args.subsets:
-    # Convert annotations
-    print('converting {} data'.format(subset))
-
-    # Select correct source files for each subset        
-    if subset == 'train' and args.version != 'challenge_2019':
+def get_source_files(subset, version):
+    """
+    Select correct source files for a subset
+    """
+    if subset == 'train' and version != 'challenge_2019':
         category_sourcefile = 'class-descriptions-boxable.csv'
         image_sourcefile = 'train-images-boxable-with-rotation.csv'
-        if args.version == 'v6':
+        if version == 'v6':
             annotation_sourcefile = 'oidv6-train-annotations-bbox.csv'
         else:
             annotation_sourcefile = 'train-annotations-bbox.csv'
@@ -53,7 +113,7 @@ for subset in args.subsets:
         segmentation_sourcefile = 'validation-annotations-object-segmentation.csv'
         segmentation_folder = 'annotations/validation_masks/'
 
-    elif subset == 'val' and args.version != 'challenge_2019':
+    elif subset == 'val' and version != 'challenge_2019':
         category_sourcefile = 'class-descriptions-boxable.csv'
         image_sourcefile = 'validation-images-with-rotation.csv'
         annotation_sourcefile = 'validation-annotations-bbox.csv'
@@ -62,14 +122,16 @@ for subset in args.subsets:
         segmentation_sourcefile = 'validation-annotations-object-segmentation.csv'
         segmentation_folder = 'annotations/validation_masks/'
 
-    elif subset == 'test' and args.version != 'challenge_2019':
+    elif subset == 'test' and version != 'challenge_2019':
         category_sourcefile = 'class-descriptions-boxable.csv'
         image_sourcefile = 'test-images-with-rotation.csv'
         annotation_sourcefile = 'test-annotations-bbox.csv'
         image_label_sourcefile = 'test-annotations-human-imagelabels-boxable.csv'
-        image_size_sourcefile = None
+        image_size_sourcefile = 'test_sizes-00000-of-00001.csv'
+        segmentation_sourcefile = None
+        segmentation_folder = None
 
-    elif subset == 'train' and args.version == 'challenge_2019':
+    elif subset == 'train' and version == 'challenge_2019':
         category_sourcefile = 'challenge-2019-classes-description-500.csv'
         image_sourcefile = 'train-images-boxable-with-rotation.csv'
         annotation_sourcefile = 'challenge-2019-train-detection-bbox.csv'
@@ -78,7 +140,7 @@ for subset in args.subsets:
         segmentation_sourcefile = 'challenge-2019-train-segmentation-masks.csv'
         segmentation_folder = 'annotations/challenge_2019_train_masks/'
 
-    elif subset == 'val' and args.version == 'challenge_2019':
+    elif subset == 'val' and version == 'challenge_2019':
         category_sourcefile = 'challenge-2019-classes-description-500.csv'
         image_sourcefile = 'validation-images-with-rotation.csv'
         annotation_sourcefile = 'challenge-2019-validation-detection-bbox.csv'
@@ -87,67 +149,170 @@ for subset in args.subsets:
         segmentation_sourcefile = 'challenge-2019-validation-segmentation-masks.csv'
         segmentation_folder = 'annotations/challenge_2019_validation_masks/'
 
-    # Load original annotations
-    print('loading original annotations ...', end='\r')
-    original_category_info = utils.csvread(os.path.join(base_dir, 'annotations', category_sourcefile))
-    original_image_metadata = utils.csvread(os.path.join(base_dir, 'annotations', image_sourcefile))
-    original_image_annotations = utils.csvread(os.path.join(base_dir, 'annotations', image_label_sourcefile))
-    original_image_sizes = utils.csvread(os.path.join('data/', image_size_sourcefile))
-    if args.task == 'bbox':
-        original_annotations = utils.csvread(os.path.join(base_dir, 'annotations', annotation_sourcefile))
-    elif args.task == 'panoptic':
-        original_segmentations = utils.csvread(os.path.join(base_dir, 'annotations', segmentation_sourcefile))
-        original_mask_dir = os.path.join(base_dir, segmentation_folder)
-        segmentation_out_dir = os.path.join(base_dir, 'annotations/{}_{}_{}/'.format(args.task, subset, args.version))
-        
-    print('loading original annotations ... Done')
-
-    oi = {}
-
-    # Add basic dataset info
-    print('adding basic dataset info')
-    oi['info'] = {'contributos': 'Vittorio Ferrari, Tom Duerig, Victor Gomes, Ivan Krasin,\
+    return {'category': category_sourcefile,
+            'image': image_sourcefile,
+            'annotation': annotation_sourcefile,
+            'image_label': image_label_sourcefile,
+            'image_size': image_size_sourcefile,
+            'segmentation': segmentation_sourcefile,
+            'segmentation_folder': segmentation_folder}
+
+def dataset_info(version):
+    return {'contributos': 'Vittorio Ferrari, Tom Duerig, Victor Gomes, Ivan Krasin,\
                   David Cai, Neil Alldrin, Ivan Krasinm, Shahab Kamali, Zheyun Feng,\
                   Anurag Batra, Alok Gunjan, Hassan Rom, Alina Kuznetsova, Jasper Uijlings,\
                   Stefan Popov, Matteo Malloci, Sami Abu-El-Haija, Rodrigo Benenson,\
                   Jordi Pont-Tuset, Chen Sun, Kevin Murphy, Jake Walker, Andreas Veit,\
                   Serge Belongie, Abhinav Gupta, Dhyanesh Narayanan, Gal Chechik',
-                  'description': 'Open Images Dataset {}'.format(args.version),
-                  'url': 'https://storage.googleapis.com/openimages/web/index.html',
-                  'version': '{}'.format(args.version),
-                  'year': 2020}
-
-    # Add license information
-    print('adding basic license info')
-    oi['licenses'] = [{'id': 1, 'name': 'Attribution-NonCommercial-ShareAlike License', 'url': 'http://creativecommons.org/licenses/by-nc-sa/2.0/'},
-                      {'id': 2, 'name': 'Attribution-NonCommercial License', 'url': 'http://creativecommons.org/licenses/by-nc/2.0/'},
-                      {'id': 3, 'name': 'Attribution-NonCommercial-NoDerivs License', 'url': 'http://creativecommons.org/licenses/by-nc-nd/2.0/'},
-                      {'id': 4, 'name': 'Attribution License', 'url': 'http://creativecommons.org/licenses/by/2.0/'},
-                      {'id': 5, 'name': 'Attribution-ShareAlike License', 'url': 'http://creativecommons.org/licenses/by-sa/2.0/'},
-                      {'id': 6, 'name': 'Attribution-NoDerivs License', 'url': 'http://creativecommons.org/licenses/by-nd/2.0/'},
-                      {'id': 7, 'name': 'No known copyright restrictions', 'url': 'http://flickr.com/commons/usage/'},
-                      {'id': 8, 'name': 'United States Government Work', 'url': 'http://www.usa.gov/copyright.shtml'}]
-
-    # Convert category information
-    print('converting category info')
-    oi['categories'] = utils.convert_category_annotations(original_category_info)
+            'description': 'Open Images Dataset {}'.format(version),
+            'url': 'https://storage.googleapis.com/openimages/web/index.html',
+            'version': '{}'.format(version),
+            'year': 2020}
+
+LICENSES = [{'id': 1, 'name': 'Attribution-NonCommercial-ShareAlike License', 'url': 'http://creativecommons.org/licenses/by-nc-sa/2.0/'},
+            {'id': 2, 'name': 'Attribution-NonCommercial License', 'url': 'http://creativecommons.org/licenses/by-nc/2.0/'},
+            {'id': 3, 'name': 'Attribution-NonCommercial-NoDerivs License', 'url': 'http://creativecommons.org/licenses/by-nc-nd/2.0/'},
+            {'id': 4, 'name': 'Attribution License', 'url': 'http://creativecommons.org/licenses/by/2.0/'},
+            {'id': 5, 'name': 'Attribution-ShareAlike License', 'url': 'http://creativecommons.org/licenses/by-sa/2.0/'},
+            {'id': 6, 'name': 'Attribution-NoDerivs License', 'url': 'http://creativecommons.org/licenses/by-nd/2.0/'},
+            {'id': 7, 'name': 'No known copyright restrictions', 'url': 'http://flickr.com/commons/usage/'},
+            {'id': 8, 'name': 'United States Government Work', 'url': 'http://www.usa.gov/copyright.shtml'}]
+
+def convert_subset(args, subset, categories):
+    """
+    Convert all requested tasks of one subset
+    The image annotations are loaded and converted once and shared by the tasks
+    """
+    base_dir = args.path
+    source_files = get_source_files(subset, args.version)
+    stages = _profiler(args, subset)
+
+    # Load original annotations
+    print('[{}] loading original annotations ...'.format(subset))
+    with stages.stage('csv:image') as stage:
+        original_image_metadata = utils.csvread_columns(os.path.join(base_dir, 'annotations', source_files['image']),
+                                                        usecols=['ImageID', 'OriginalURL', 'License'],
+                                                        cache=args.cache, workers=args.csv_workers)
+        stage.rows = _num_rows(original_image_metadata)
+    with stages.stage('csv:image_label') as stage:
+        original_image_annotations = utils.csvread_columns(os.path.join(base_dir, 'annotations', source_files['image_label']),
+                                                           usecols=['ImageID', 'LabelName', 'Confidence'],
+                                                           cache=args.cache, workers=args.csv_workers)
+        stage.rows = _num_rows(original_image_annotations)
+    # sizes missing from data/ are read from the images and added to the size csv
+    image_size_file = os.path.join('data/', source_files['image_size'])
+    if os.path.isfile(image_size_file):
+        with stages.stage('csv:image_size') as stage:
+            original_image_sizes = utils.csvread_columns(image_size_file, cache=args.cache, workers=args.csv_workers)
+            stage.rows = _num_rows(original_image_sizes)
+    else:
+        original_image_sizes = None
+    print('[{}] loading original annotations ... Done'.format(subset))
 
     # Convert image mnetadata
-    print('converting image info ...')
+    print('[{}] converting image info ...'.format(subset))
     image_dir = os.path.join(base_dir, subset)
-    oi['images'] = utils.convert_image_annotations(original_image_metadata, original_image_annotations, original_image_sizes, image_dir, oi['categories'], oi['licenses'])
-
-    # Convert instance annotations
-    print('converting annotations ...')
-    # Convert annotations
-    if args.task == 'bbox':
-        oi['annotations'] = utils.convert_instance_annotations(original_annotations, oi['images'], oi['categories'], start_index=0)
-    elif args.task == 'panoptic':
-        oi['annotations'] = utils.convert_segmentation_annotations(original_segmentations, oi['images'], oi['categories'], original_mask_dir, segmentation_out_dir, start_index=0)
-        oi['images'] = utils.filter_images(oi['images'], oi['annotations'])
-
-    # Write annotations into .json file
-    filename = os.path.join(base_dir, 'annotations/', 'openimages_{}_{}_{}.json'.format(args.version, subset, args.task))
-    print('writing output to {}'.format(filename))
-    json.dump(oi,  open(filename, "w"))
-    print('Done')
\ No newline at end of file
+    with stages.stage('images', rows=_num_rows(original_image_metadata)):
+        images = utils.convert_image_annotations(original_image_metadata, original_image_annotations, original_image_sizes, image_dir, categories, LICENSES, size_file=image_size_file)
+
+    for task in args.task:
+        oi = {}
+        oi['info'] = dataset_info(args.version)
+        oi['licenses'] = LICENSES
+        oi['categories'] = categories
+        oi['images'] = images
+
+        # Convert instance annotations
+        print('[{}] converting {} annotations ...'.format(subset, task))
+        # bbox annotations are converted lazily while the output file is written
+        if task == 'bbox':
+            with stages.stage('csv:annotation') as stage:
+                original_annotations = utils.csvread_columns(os.path.join(base_dir, 'annotations', source_files['annotation']), cache=args.cache, workers=args.csv_workers)
+                stage.rows = _num_rows(original_annotations)
+            # the conversion time is measured per chunk inside the iterator and not counted for the json write
+            oi['annotations'] = stages.iterate('annotations:bbox',
+                                               utils.iter_instance_annotation_chunks(original_annotations, images, categories, start_index=0, sort_by_image=args.shard_size > 0))
+            if args.store:
+                store_dir = os.path.join(base_dir, 'annotations/', 'openimages_{}_{}_{}_store'.format(args.version, subset, task))
+                print('[{}] writing annotation store to {}'.format(subset, store_dir))
+                with stages.stage('store:bbox', rows=_num_rows(original_annotations)):
+                    utils.write_annotation_store(store_dir, original_annotations, images, categories, start_index=0)
+        elif task == 'panoptic':
+            if source_files['segmentation'] is None:
+                print('[{}] no segmentation annotations, skipping panoptic task'.format(subset))
+                continue
+            with stages.stage('csv:segmentation') as stage:
+                original_segmentations = utils.csvread(os.path.join(base_dir, 'annotations', source_files['segmentation']))
+                stage.rows = len(original_segmentations) - 1
+            original_mask_dir = os.path.join(base_dir, source_files['segmentation_folder'])
+            segmentation_out_dir = os.path.join(base_dir, 'annotations/{}_{}_{}/'.format(task, subset, args.version))
+            # reading the masks and writing the panoptic pngs, rows are segments
+            writer = png_writer.PngWriter(args.png_writer, args.png_level, threaded=args.png_thread)
+            with stages.stage('masks:panoptic', rows=len(original_segmentations) - 1):
+                oi['annotations'] = utils.convert_segmentation_annotations(original_segmentations, images, categories, original_mask_dir, segmentation_out_dir, start_index=0, workers=args.workers, resume=args.resume, writer=writer)
+                oi['images'] = utils.filter_images(images, oi['annotations'])
+
+        # Write annotations into .json file
+        filename = os.path.join(base_dir, 'annotations/', 'openimages_{}_{}_{}.json'.format(args.version, subset, task))
+        if args.gzip:
+            filename += '.gz'
+        print('[{}] writing output to {}'.format(subset, filename))
+        with stages.stage('json:{}'.format(task), rows=len(oi['images'])):
+            if args.shard_size > 0:
+                utils.write_coco_shards(oi, filename, args.shard_size, compact=args.compact)
+            else:
+                utils.write_coco_json(oi, filename, compact=args.compact)
+        print('[{}] writing output to {} ... Done'.format(subset, filename))
+
+    return stages.records
+
+def _profiler(args, label):
+    return profiler.StageProfiler(enabled=args.profile,
+                                  label=label,
+                                  cprofile_stages=args.cprofile,
+                                  cprofile_prefix=os.path.splitext(args.profile_output)[0])
+
+def _num_rows(columns):
+    return len(next(iter(columns.values()))) if columns else 0
+
+def main():
+    args = parse_args()
+    if not isinstance(args.subsets, list):
+        args.subsets = [args.subsets]
+    if not isinstance(args.task, list):
+        args.task = [args.task]
+
+    # categories only depend on the version and are shared by all subsets
+    print('converting category info')
+    stages = _profiler(args, 'all')
+    category_sourcefile = get_source_files(args.subsets[0], args.version)['category']
+    with stages.stage('csv:category') as stage:
+        original_category_info = utils.csvread(os.path.join(args.path, 'annotations', category_sourcefile))
+        stage.rows = len(original_category_info)
+    with stages.stage('categories', rows=len(original_category_info)):
+        categories = utils.convert_category_annotations(original_category_info)
+
+    records = stages.records
+    if args.subset_workers > 1 and len(args.subsets) > 1:
+        # subsets are independent, each one is converted in its own process
+        with ProcessPoolExecutor(min(args.subset_workers, len(args.subsets))) as executor:
+            futures = [executor.submit(convert_subset, args, subset, categories) for subset in args.subsets]
+            for future in futures:
+                records += future.result()
+    else:
+        for subset in args.subsets:
+            records += convert_subset(args, subset, categories)
+
+    if args.profile:
+        profiler.write_report(args.profile_output, records,
+                              version=args.version,
+                              subsets=args.subsets,
+                              tasks=args.task,
+                              workers=args.workers,
+                              subset_workers=args.subset_workers)
+        print('profile written to {}'.format(args.profile_output))
+    print('Done')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,11 @@
 import os
+import csv
 import json
+import tempfile
 import utils
 import argparse
 
-import imagesize
 from tqdm import tqdm
-from collections import defaultdict
 
 def parse_args():
     """
@@ -29,65 +29,108 @@ def parse_args():
                         default='bbox',
                         choices=['bbox'],
                         help='type of annotations (only bbox supported for now)')
+    parser.add_argument('--size_file',
+                        default=None,
+                        help='csv caching the sizes read from --image_dir (default: data/<image_dir name>_sizes-00000-of-00001.csv)',
+                        type=str)
+    parser.add_argument('--csv_workers',
+                        type=int,
+                        default=1,
+                        help='number of processes parsing chunks of the size csv')
+    parser.add_argument('--stream',
+                        action='store_true',
+                        help='parse the predictions incrementally and write each image as soon as it is done')
+    parser.add_argument('--spill_buckets',
+                        type=int,
+                        default=64,
+                        help='number of temporary files used with --stream when predictions are not grouped by image')
     args = parser.parse_args()
     return args
 
-args = parse_args()
+def load_image_sizes(args, predictions=None):
+    # returns the sizes of all images and the image ids to write
+    if args.subset:
+        image_size_sourcefile = 'data/{}_sizes-00000-of-00001.csv'.format(args.subset)
+        image_size_dict = utils.image_sizes_to_dict(utils.csvread_columns(image_size_sourcefile, workers=args.csv_workers))
+        image_ids = list(image_size_dict.keys())
+        image_ids.sort()
+    else:
+        # sizes read from the images are cached in data/ for later runs
+        size_file = args.size_file
+        if size_file is None:
+            size_file = 'data/{}_sizes-00000-of-00001.csv'.format(os.path.basename(os.path.normpath(args.image_dir)))
+        if os.path.isfile(size_file):
+            image_size_dict = utils.image_sizes_to_dict(utils.csvread_columns(size_file, workers=args.csv_workers))
+        else:
+            image_size_dict = {}
+        images = os.listdir(args.image_dir)
+        image_ids = [os.path.splitext(x)[0] for x in images]
+        # without loaded predictions every image in the folder may be needed
+        if predictions is not None:
+            missing_image_ids = sorted({pred['image_id'] for pred in predictions if pred['image_id'] not in image_size_dict})
+        else:
+            missing_image_ids = sorted(image_id for image_id in image_ids if image_id not in image_size_dict)
+        if missing_image_ids:
+            image_size_dict.update(utils.probe_image_sizes(missing_image_ids, args.image_dir, size_file=size_file))
+    return image_size_dict, image_ids
 
-assert args.subset or args.image_dir, "provide either a split to get image sized from data/ or the directory where the images are stored"
+def convert(args, outfile):
+    print('loading predictions')
+    predictions = json.load(open(args.predictions))
+    print('loading predictions ... Done')
 
-print('loading predictions')
-predictions = json.load(open(args.predictions))
-print('loading predictions ... Done')
-    
-if args.subset:
-    image_size_sourcefile = 'data/{}_sizes-00000-of-00001.csv'.format(args.subset)
-    original_image_sizes = utils.csvread(image_size_sourcefile)
-    image_size_dict = {x[0]:  [int(x[1]), int(x[2])] for x in original_image_sizes[1:]}
-    image_ids = list(image_size_dict.keys())
-    image_ids.sort()
-else:
-    image_size_dict = {}
-    images = os.listdir(args.image_dir)
-    image_ids = [os.path.splitext(x)[0] for x in images]
+    image_size_dict, image_ids = load_image_sizes(args, predictions)
 
-# prepare per instance information
-img_pred_map = defaultdict(list)
-for pred in tqdm(predictions, desc='Converting predictions '):
-    image_id = pred['image_id']
-    cat = pred['category_id']
-    
-    # Extract height and width
-    image_size = image_size_dict.get(image_id, None)
-    if image_size is not None:
-        image_width, image_height = image_size
-    else:
-        filename = os.path.join(args.image_dir, image_id + '.jpg')
-        image_width, image_height = imagesize.get(filename)
-        image_size_dict[image_id] = image_width, image_height
+    print('converting predictions ...')
+    converted_predictions = [['ImageId', 'PredictionString']]
+    converted_predictions += utils.convert_prediction_strings(predictions, image_size_dict, image_ids)
+        
+    print(f'savind converted predictions to {outfile}')
+    utils.csvwrite(converted_predictions, outfile)
+    print(f'savind converted predictions to {outfile} ... Done')
+
+def _write_streamed(outfile, image_ids, prediction_strings):
+    # rows are written while predictions are parsed, images without any prediction come last
+    written = set()
+    with open(outfile, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ImageId', 'PredictionString'])
+        for image_id, prediction_string in tqdm(prediction_strings, desc='Converting predictions ', unit='img'):
+            writer.writerow([image_id, prediction_string])
+            written.add(image_id)
+        for image_id in image_ids:
+            if image_id not in written:
+                writer.writerow([image_id, ''])
 
-    xmin = pred['bbox'][0] / image_width
-    ymin = pred['bbox'][1] / image_height
-    xmax = xmin + pred['bbox'][2] / image_width
-    ymax = ymin + pred['bbox'][3] / image_height
-    
-    conf = pred['score']
-    
-    img_pred_map[image_id].append(f"{cat} {conf:.4f} {xmin:.4f} {ymin:.4f} {xmax:.4f} {ymax:.4f}")
-    
-    
-# collect into per image strings
-converted_predictions = [['ImageId', 'PredictionString']]
-for image_id in image_ids:
-    results = img_pred_map[image_id]
-    result_string = ''
-    for result in results:
-        result_string += ' ' + result
+def convert_streaming(args, outfile):
+    # bounded memory: the predictions are never loaded as a whole
+    image_size_dict, image_ids = load_image_sizes(args)
+
+    tmp_outfile = outfile + '.tmp'
+    print(f'streaming converted predictions to {outfile}')
+    try:
+        predictions = utils.iter_json_array(args.predictions)
+        _write_streamed(tmp_outfile, image_ids, utils.iter_grouped_prediction_strings(predictions, image_size_dict))
+    except utils.PredictionsNotGrouped as e:
+        print(f'predictions are not grouped by image (image {e} appears twice), grouping through temporary files')
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(outfile))) as spill_dir:
+            predictions = utils.iter_json_array(args.predictions)
+            prediction_strings = utils.iter_spilled_prediction_strings(predictions, image_size_dict, spill_dir, args.spill_buckets)
+            _write_streamed(tmp_outfile, image_ids, prediction_strings)
+    os.replace(tmp_outfile, outfile)
+    print(f'streaming converted predictions to {outfile} ... Done')
+
+def main():
+    args = parse_args()
+
+    assert args.subset or args.image_dir, "provide either a split to get image sized from data/ or the directory where the images are stored"
+
+    outfile = os.path.splitext(args.predictions)[0] + '.csv'
+    if args.stream:
+        convert_streaming(args, outfile)
+    else:
+        convert(args, outfile)
 
-    converted_predictions.append([image_id, result_string[1:]])
-    
 
-outfile = os.path.splitext(args.predictions)[0] + '.csv'
-print(f'savind converted predictions to {outfile}')
-utils.csvwrite(converted_predictions, outfile)
-print(f'savind converted predictions to {outfile} ... Done')
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import os
+import json
+import utils
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from tqdm import tqdm
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Convert MS Coco bbox annotations back into Open Images csv files')
+    parser.add_argument('-a', '--annotations', dest='annotations',
+                        nargs='+',
+                        help='coco annotation files (.json or .json.gz) or the _index.json of sharded files',
+                        type=str)
+    parser.add_argument('--bbox_file',
+                        default=None,
+                        help='output bbox csv (default: <annotations>-annotations-bbox.csv)',
+                        type=str)
+    parser.add_argument('--label_file',
+                        default=None,
+                        help='output image level label csv (default: <annotations>-annotations-human-imagelabels-boxable.csv)',
+                        type=str)
+    parser.add_argument('--chunk_size',
+                        type=int,
+                        default=100000,
+                        help='number of images or annotations converted at once')
+    args = parser.parse_args()
+    return args
+
+def input_files(files):
+    # shard index files are replaced by the shards they list
+    expanded = []
+    for file in files:
+        if file.endswith('_index.json'):
+            with open(file, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            expanded += [os.path.join(os.path.dirname(file), shard['file']) for shard in index['shards']]
+        else:
+            expanded.append(file)
+    return expanded
+
+def _output_prefix(file):
+    for extension in ['_index.json', '.json.gz', '.json']:
+        if file.endswith(extension):
+            return file[:-len(extension)]
+    return file
+
+class _CsvAppender:
+    # appends column chunks to a csv file, the header is taken from the first chunk
+    # and every later chunk must have the same columns
+
+    def __init__(self, file):
+        self.file = file
+        self.f = open(file, 'w', encoding='utf-8', newline='')
+        self.header = None
+        self.rows = 0
+
+    def write(self, columns):
+        first = self.header is None
+        if first:
+            self.header = list(columns)
+        elif list(columns) != self.header:
+            raise ValueError('columns {} do not match the header {} of {}'.format(list(columns), self.header, self.file))
+        pd.DataFrame(columns).to_csv(self.f, header=first, index=False)
+        self.rows += len(next(iter(columns.values())))
+
+    def close(self):
+        self.f.close()
+
+def convert_file(file, bbox_csv, label_csv, chunk_size):
+    # images and annotations are converted chunk by chunk while the file is parsed
+    # sections that come before the sections they depend on (categories for both,
+    # images for annotations) are kept until the end of the file
+    categories = None
+    image_ids, widths, heights = [], [], []
+    image_columns = None
+    images_converted = False
+    deferred = []
+
+    def convert(key, chunk):
+        nonlocal image_columns, images_converted
+        if key == 'images':
+            images_converted = True
+            image_ids.extend(img['id'] for img in chunk)
+            widths.extend(img['width'] for img in chunk)
+            heights.extend(img['height'] for img in chunk)
+            columns = utils.convert_coco_image_labels(chunk, categories)
+            if len(columns['ImageID']):
+                label_csv.write(columns)
+        else:
+            if image_columns is None:
+                # the last image of a duplicated id wins
+                index = pd.Index(image_ids)
+                unique = ~index.duplicated(keep='last')
+                image_columns = (index[unique], np.array(widths, dtype='float64')[unique], np.array(heights, dtype='float64')[unique])
+            bbox_csv.write(utils.convert_coco_instances(chunk, *image_columns, categories))
+
+    with tqdm(desc='Converting {}'.format(os.path.basename(file)), unit='items') as pbar:
+        for key, value in utils.iter_coco_sections(file, chunk_size):
+            if key == 'categories':
+                categories = value
+            elif key in ('images', 'annotations'):
+                # the images section is complete once another section starts, so annotations
+                # are converted right away if the images before them were converted
+                ready = categories is not None and (key == 'images' or images_converted)
+                if ready:
+                    convert(key, value)
+                else:
+                    deferred.append((key, value))
+                pbar.update(len(value))
+
+        if categories is None:
+            raise ValueError('{} has no categories'.format(file))
+        # deferred images are converted before deferred annotations
+        for key, value in sorted(deferred, key=lambda item: item[0] != 'images'):
+            convert(key, value)
+
+def main():
+    args = parse_args()
+
+    files = input_files(args.annotations)
+    prefix = _output_prefix(args.annotations[0])
+    bbox_file = args.bbox_file or prefix + '-annotations-bbox.csv'
+    label_file = args.label_file or prefix + '-annotations-human-imagelabels-boxable.csv'
+
+    bbox_csv = _CsvAppender(bbox_file + '.tmp')
+    label_csv = _CsvAppender(label_file + '.tmp')
+    try:
+        for file in files:
+            convert_file(file, bbox_csv, label_csv, args.chunk_size)
+    finally:
+        bbox_csv.close()
+        label_csv.close()
+    os.replace(bbox_csv.file, bbox_file)
+    os.replace(label_csv.file, label_file)
+    print('wrote {} boxes to {}'.format(bbox_csv.rows, bbox_file))
+    print('wrote {} image level labels to {}'.format(label_csv.rows, label_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import os
+import zlib
+import struct
+import warnings
+import threading
+
+import numpy as np
+import skimage.io as io
+
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def write_png_skimage(file, rgb, level=None):
+    # the original writer, skimage does not expose the compression level
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        io.imsave(file, rgb)
+
+def write_png_pil(file, rgb, level=None):
+    # with the default level the file is identical to the one written by skimage
+    Image.fromarray(rgb).save(file, format='PNG', compress_level=6 if level is None else level)
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+def write_png_zlib(file, rgb, level=None):
+    # minimal 8 bit rgb png, rows are not filtered and compressed with zlib at level
+    # panoptic pngs are large flat areas, so filtering gains little over a low level
+    height, width, _ = rgb.shape
+    rows = np.zeros((height, 1 + 3 * width), dtype='uint8')
+    rows[:, 1:] = rgb.reshape(height, 3 * width)
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    with open(file, 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        f.write(_png_chunk(b'IHDR', header))
+        f.write(_png_chunk(b'IDAT', zlib.compress(rows, 1 if level is None else level)))
+        f.write(_png_chunk(b'IEND', b''))
+
+PNG_WRITERS = {'skimage': write_png_skimage,
+               'pil': write_png_pil,
+               'zlib': write_png_zlib}
+
+# rgb buffer reused by the synchronous writers of a process, keyed by shape
+_rgb_buffers = {}
+
+
+class PngWriter:
+    """
+    Writes panoptic pngs with one of the PNG_WRITERS backends
+    With threaded=True pngs are encoded on a background thread, at most max_pending
+    wait in memory and each file is moved into place only once it is complete
+    Copies sent to worker processes always write synchronously
+    """
+
+    def __init__(self, backend='pil', level=None, threaded=False, max_pending=8):
+        if backend not in PNG_WRITERS:
+            raise ValueError('unknown png writer {}, choose one of {}'.format(backend, sorted(PNG_WRITERS)))
+        self.backend = backend
+        self.level = level
+        self.threaded = threaded
+        self.max_pending = max_pending
+        self._executor = None
+        self._pending = []
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def __getstate__(self):
+        return {'backend': self.backend, 'level': self.level}
+
+    def __setstate__(self, state):
+        self.__init__(state['backend'], state['level'])
+
+    def buffer(self, shape):
+        # uint8 (height, width, 3) array to fill before write
+        # synchronous writes reuse one buffer per shape, a threaded write owns its buffer
+        if self.threaded:
+            return np.empty(shape + (3,), dtype='uint8')
+        if shape not in _rgb_buffers:
+            _rgb_buffers.clear()
+            _rgb_buffers[shape] = np.empty(shape + (3,), dtype='uint8')
+        return _rgb_buffers[shape]
+
+    def write(self, file, rgb):
+        write = PNG_WRITERS[self.backend]
+        if not self.threaded:
+            write(file, rgb, self.level)
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1)
+        self._slots.acquire()
+        # raise errors of finished writes early
+        for future in self._pending:
+            if future.done():
+                future.result()
+        self._pending = [future for future in self._pending if not future.done()]
+        self._pending.append(self._executor.submit(self._write_complete, write, file, rgb))
+
+    def _write_complete(self, write, file, rgb):
+        try:
+            # keep the extension, skimage picks the format by it
+            tmp_file = '{}.tmp{}'.format(*os.path.splitext(file))
+            write(tmp_file, rgb, self.level)
+            os.replace(tmp_file, file)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        # wait for pending writes, errors of the background thread are raised here
+        if self._executor is None:
+            return
+        try:
+            for future in self._pending:
+                future.result()
+        finally:
+            self._executor.shutdown()
+            self._executor = None
+            self._pending = []
+
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import cProfile
+
+from itertools import chain
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak rss is reported as None there
+    resource = None
+
+
+def _peak_rss_mb():
+    # high water mark of the resident set size of this process
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is not None:
+        # kilobytes on linux, the fallback for systems without /proc
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return None
+
+def _reset_peak_rss():
+    # writing 5 to clear_refs resets VmHWM (linux >= 4.0), so each stage gets its own peak
+    # elsewhere the peak is the maximum since the process started
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _children_cpu_seconds():
+    # cpu time of finished child processes, e.g. the panoptic mask workers
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+class _Stage:
+    """
+    Wall and cpu time of one stage, the stage can be paused and resumed
+    Time spent in nested stages is not counted for the enclosing stage
+    """
+
+    def __init__(self, profiler, name, rows, cprofile):
+        self.profiler = profiler
+        self.name = name
+        self.rows = rows
+        self.cprofile = cProfile.Profile() if cprofile else None
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.children_cpu = 0.0
+        self.peak_rss = None
+        self._parent = None
+
+    def resume(self):
+        stack = self.profiler._stack
+        if stack:
+            self._parent = stack[-1]
+            self._parent._pause_clock()
+        else:
+            self._parent = None
+            _reset_peak_rss()
+        stack.append(self)
+        self._start_clock()
+
+    def pause(self):
+        self._pause_clock()
+        self.profiler._stack.pop()
+        if self._parent is not None:
+            self._parent._start_clock()
+        else:
+            # resuming a top level stage resets the peak, so it is read before that can happen
+            self._read_peak_rss()
+
+    def _read_peak_rss(self):
+        peak_rss = _peak_rss_mb()
+        if peak_rss is not None:
+            self.peak_rss = max(self.peak_rss or 0.0, peak_rss)
+
+    def _start_clock(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self._children_cpu = _children_cpu_seconds()
+        if self.cprofile is not None:
+            self.cprofile.enable()
+
+    def _pause_clock(self):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        self.wall += time.perf_counter() - self._wall
+        self.cpu += time.process_time() - self._cpu
+        self.children_cpu += _children_cpu_seconds() - self._children_cpu
+
+    def __enter__(self):
+        self.resume()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.pause()
+        self.profiler._finish(self)
+        return False
+
+
+class _NoStage:
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class StageProfiler:
+    """
+    Records wall time, cpu time, peak rss and rows/s of named conversion stages
+    If disabled, stages and iterators are passed through without any overhead
+    Stages listed in cprofile_stages are additionally run under cProfile
+    and their stats are dumped to <cprofile_prefix>_<label>_<stage>.prof
+    """
+
+    def __init__(self, enabled=False, label=None, cprofile_stages=(), cprofile_prefix='profile'):
+        self.enabled = enabled
+        self.label = label
+        self.cprofile_stages = set(cprofile_stages)
+        self.cprofile_prefix = cprofile_prefix
+        self.records = []
+        self._stack = []
+
+    def stage(self, name, rows=None):
+        # context manager, rows can also be set on the returned stage inside the block
+        if not self.enabled:
+            return _NoStage()
+        return _Stage(self, name, rows, name in self.cprofile_stages)
+
+    def iterate(self, name, chunks, rows=None):
+        # iterate over the items of an iterable of lists, e.g. annotations converted
+        # lazily while they are written; only the work done to produce each list is
+        # timed, the time is not counted for the consumer of the items
+        if not self.enabled:
+            return chain.from_iterable(chunks)
+        return self._iterate(_Stage(self, name, rows, name in self.cprofile_stages), chunks)
+
+    def _iterate(self, stage, chunks):
+        iterator = iter(chunks)
+        count = 0
+        try:
+            while True:
+                stage.resume()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    stage.pause()
+                count += len(chunk)
+                yield from chunk
+        finally:
+            if stage.rows is None:
+                stage.rows = count
+            self._finish(stage)
+
+    def _finish(self, stage):
+        stage._read_peak_rss()
+        record = {'label': self.label,
+                  'stage': stage.name,
+                  'rows': stage.rows,
+                  'wall_seconds': round(stage.wall, 4),
+                  'cpu_seconds': round(stage.cpu, 4),
+                  'children_cpu_seconds': round(stage.children_cpu, 4),
+                  'peak_rss_mb': round(stage.peak_rss, 1) if stage.peak_rss is not None else None,
+                  'rows_per_second': round(stage.rows / stage.wall, 1) if stage.rows and stage.wall > 0 else None}
+        if stage.cprofile is not None:
+            record['cprofile'] = '{}_{}_{}.prof'.format(self.cprofile_prefix, self.label, stage.name.replace(':', '-'))
+            stage.cprofile.dump_stats(record['cprofile'])
+        self.records.append(record)
+        print('[{}] {}: {} rows in {:.2f}s (cpu {:.2f}s), peak rss {} MB'.format(
+            self.label, stage.name, stage.rows, stage.wall, stage.cpu + stage.children_cpu, record['peak_rss_mb']))
+
+
+def write_report(file, records, **info):
+    """
+    Write the stage records of one or more profilers to a json report
+    """
+    report = dict(info)
+    peaks = [record['peak_rss_mb'] for record in records if record['peak_rss_mb'] is not None]
+    report['peak_rss_mb'] = max(peaks) if peaks else None
+    report['stages'] = records
+    with open(file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,101 @@
+import os
+import json
+
+import numpy as np
+
+import utils
+
+SIZE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'validation_sizes-00000-of-00001.csv')
+ATTRIBUTES = ['IsOccluded', 'IsTruncated', 'IsGroupOf', 'IsDepiction', 'IsInside']
+
+
+def _convert_instance_annotations_loop(original_annotations, images, categories, start_index=0):
+    # the per row loop over csv columns that convert_instance_annotations used before it was vectorized
+    imgs = {img['id']: img for img in images}
+    cats_by_freebase_id = {cat['freebase_id']: cat for cat in categories}
+
+    annotations = []
+
+    annotated_attributes = [attr for attr in ATTRIBUTES if attr in original_annotations]
+
+    image_ids = original_annotations['ImageID'].tolist()
+    label_names = original_annotations['LabelName'].tolist()
+    xmins = original_annotations['XMin'].tolist()
+    ymins = original_annotations['YMin'].tolist()
+    xmaxs = original_annotations['XMax'].tolist()
+    ymaxs = original_annotations['YMax'].tolist()
+    attribute_values = [original_annotations[attribute].tolist() for attribute in annotated_attributes]
+
+    for i in range(len(image_ids)):
+        ann = {}
+        ann['id'] = i + start_index
+        image_id = image_ids[i]
+        ann['image_id'] = image_id
+        ann['freebase_id'] = label_names[i]
+        ann['category_id'] = cats_by_freebase_id[ann['freebase_id']]['id']
+        ann['iscrowd'] = False
+
+        xmin = xmins[i] * imgs[image_id]['width']
+        ymin = ymins[i] * imgs[image_id]['height']
+        xmax = xmaxs[i] * imgs[image_id]['width']
+        ymax = ymaxs[i] * imgs[image_id]['height']
+        dx = xmax - xmin
+        dy = ymax - ymin
+        ann['bbox'] = [round(a, 2) for a in [xmin, ymin, dx, dy]]
+        ann['area'] = round(dx * dy, 2)
+
+        for attribute, values in zip(annotated_attributes, attribute_values):
+            ann[attribute.lower()] = values[i]
+
+        annotations.append(ann)
+
+    return annotations
+
+
+def _write_boxes(file, image_ids, num_boxes=20000, seed=0):
+    # synthetic bbox csv in the Open Images format, coordinates with 6 decimals like the originals
+    rng = np.random.RandomState(seed)
+    labels = ['/m/{:05x}'.format(i) for i in range(600)]
+    x = np.sort(rng.rand(num_boxes, 2), axis=1)
+    y = np.sort(rng.rand(num_boxes, 2), axis=1)
+    images = rng.randint(len(image_ids), size=num_boxes)
+    label_index = rng.randint(len(labels), size=num_boxes)
+    flags = rng.randint(-1, 2, size=(num_boxes, len(ATTRIBUTES)))
+    rows = [['ImageID', 'Source', 'LabelName', 'Confidence', 'XMin', 'XMax', 'YMin', 'YMax'] + ATTRIBUTES]
+    for i in range(num_boxes):
+        rows.append([image_ids[images[i]], 'xclick', labels[label_index[i]], '1',
+                     '{:.6f}'.format(x[i, 0]), '{:.6f}'.format(x[i, 1]),
+                     '{:.6f}'.format(y[i, 0]), '{:.6f}'.format(y[i, 1])] + [str(f) for f in flags[i]])
+    utils.csvwrite(rows, file)
+    return [{'id': i + 1, 'freebase_id': label} for i, label in enumerate(labels)]
+
+
+def test_convert_instance_annotations_matches_loop(tmp_path):
+    sizes = utils.csvread(SIZE_FILE)[1:]
+    images = [{'id': image_id, 'width': int(width), 'height': int(height)} for image_id, width, height in sizes]
+
+    bbox_file = str(tmp_path / 'validation-annotations-bbox.csv')
+    categories = _write_boxes(bbox_file, [img['id'] for img in images])
+
+    original_annotations = utils.csvread_columns(bbox_file)
+    expected = _convert_instance_annotations_loop(original_annotations, images, categories, start_index=7)
+    annotations = utils.convert_instance_annotations(original_annotations, images, categories, start_index=7)
+
+    # compare the encoded strings, a failing == on the lists would make pytest diff them element by element
+    assert json.dumps(annotations) == json.dumps(expected)
+
+
+def test_convert_instance_annotations_duplicate_image_ids(tmp_path):
+    # like a dict lookup, the last image of a duplicated id gives the size
+    sizes = utils.csvread(SIZE_FILE)[1:1001]
+    images = [{'id': image_id, 'width': int(width), 'height': int(height)} for image_id, width, height in sizes]
+    images += [{'id': img['id'], 'width': img['width'] + 100, 'height': img['height'] + 50} for img in images[::3]]
+
+    bbox_file = str(tmp_path / 'validation-annotations-bbox.csv')
+    categories = _write_boxes(bbox_file, [img['id'] for img in images], num_boxes=2000)
+
+    original_annotations = utils.csvread_columns(bbox_file)
+    expected = _convert_instance_annotations_loop(original_annotations, images, categories)
+    annotations = utils.convert_instance_annotations(original_annotations, images, categories)
+
+    assert json.dumps(annotations) == json.dumps(expected)
@@ -1,13 +1,30 @@
 import os
+import io
+import re
+import gc
 import csv
-import warnings
+import json
+import gzip
+import shutil
+import hashlib
+import zlib
+import struct
 import imagesize
+import multiprocessing
 
 import numpy as np
-import skimage.io as io
+import pandas as pd
+
+from PIL import Image
+
+import png_writer
+import annotation_store
 
 from tqdm import tqdm
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict
+from collections.abc import Iterable
 
 def csvread(file):
     if file:       
@@ -21,29 +38,458 @@ def csvread(file):
         
     return data
 
+# column types of the Open Images csv files
+# string columns are parsed as categoricals so that repeated ids share one object
+CSV_DTYPES = {'ImageID': 'category',
+              'Source': 'category',
+              'LabelName': 'category',
+              'Confidence': 'int8',
+              'XMin': 'float64',
+              'XMax': 'float64',
+              'YMin': 'float64',
+              'YMax': 'float64',
+              'IsOccluded': 'int8',
+              'IsTruncated': 'int8',
+              'IsGroupOf': 'int8',
+              'IsDepiction': 'int8',
+              'IsInside': 'int8',
+              'OriginalURL': 'object',
+              'License': 'category',
+              'image_id': 'object',
+              'image_w': 'int64',
+              'image_h': 'int64'}
+
+def _cache_dir(file, usecols):
+    # one cache folder per csv file and column selection, placed next to the file
+    key = json.dumps([sorted(usecols) if usecols is not None else None, CSV_DTYPES], sort_keys=True)
+    digest = hashlib.md5(key.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(os.path.dirname(os.path.abspath(file)), '.csvcache', '{}-{}'.format(os.path.basename(file), digest))
+
+def _source_stamp(file):
+    stat = os.stat(file)
+    return {'path': os.path.abspath(file), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def _load_column_cache(file, cache_dir):
+    # returns None if there is no cache or the csv changed since it was written
+    meta_file = os.path.join(cache_dir, 'meta.json')
+    if not os.path.isfile(meta_file):
+        return None
+    with open(meta_file, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta['source'] != _source_stamp(file):
+        return None
+
+    data = {}
+    for column in meta['columns']:
+        column_file = os.path.join(cache_dir, '{}.npy'.format(column))
+        if column in meta['strings']:
+            # strings are stored as codes into a newline separated utf-8 blob
+            codes = np.load(column_file, mmap_mode='r')
+            num_strings = meta['strings'][column]
+            blob = np.load(os.path.join(cache_dir, '{}.strings.npy'.format(column))).tobytes().decode('utf-8')
+            strings = np.array(blob.split('\n') if num_strings else [], dtype=object)
+            data[column] = strings[codes]
+        else:
+            data[column] = np.load(column_file, mmap_mode='r')
+    return data
+
+def _save_column_cache(file, cache_dir, data):
+    strings = {}
+    tmp_dir = cache_dir + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    for column in data.columns:
+        column_file = os.path.join(tmp_dir, '{}.npy'.format(column))
+        if data[column].dtype.kind in 'iuf':
+            np.save(column_file, data[column].to_numpy())
+            continue
+        if isinstance(data[column].dtype, pd.CategoricalDtype):
+            codes, uniques = data[column].cat.codes.to_numpy(), data[column].cat.categories
+        else:
+            codes, uniques = pd.factorize(data[column].to_numpy())
+        uniques = [str(x) for x in uniques]
+        if any('\n' in x for x in uniques):
+            # cannot be stored in the newline separated blob, keep parsing the csv
+            shutil.rmtree(tmp_dir)
+            return
+        np.save(column_file, codes.astype('int32'))
+        blob = '\n'.join(uniques).encode('utf-8')
+        np.save(os.path.join(tmp_dir, '{}.strings.npy'.format(column)), np.frombuffer(blob, dtype='uint8'))
+        strings[column] = len(uniques)
+    # meta.json is written last, a cache without it is never used
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'source': _source_stamp(file), 'columns': list(data.columns), 'strings': strings}, f)
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.replace(tmp_dir, cache_dir)
+
+# byte ranges smaller than this are not worth a separate process
+MIN_CSV_CHUNK = 16 * 2**20
+
+def _read_csv(file, usecols, **kwargs):
+    # pandas csv parser with the column types used throughout the conversion
+    if usecols is not None:
+        wanted = set(usecols)
+        usecols = lambda column: column in wanted
+    return pd.read_csv(file,
+                       usecols=usecols,
+                       dtype=CSV_DTYPES,
+                       keep_default_na=False,
+                       float_precision='round_trip',
+                       encoding='utf-8',
+                       **kwargs)
+
+def _read_range(file, start, end, block_size=MIN_CSV_CHUNK):
+    # yield the bytes of file[start:end] in blocks
+    with open(file, 'rb') as f:
+        f.seek(start)
+        while start < end:
+            block = f.read(min(block_size, end - start))
+            if not block:
+                return
+            start += len(block)
+            yield block
+
+def _count_quotes(task):
+    file, start, end = task
+    return sum(block.count(b'"') for block in _read_range(file, start, end))
+
+def _parse_csv_range(task):
+    file, start, end, names, usecols = task
+    data = b''.join(_read_range(file, start, end, end - start))
+    return _read_csv(io.BytesIO(data), usecols, header=None, names=names)
+
+def _csv_ranges(file, num_chunks, pool):
+    # split the rows of a csv file into byte ranges that start after a newline
+    # a newline inside a quoted field is no row boundary, those are recognized
+    # by an odd number of quotes before them and the ranges are merged
+    with open(file, 'rb') as f:
+        header = f.readline()
+        size = os.fstat(f.fileno()).st_size
+        boundaries = [f.tell()]
+        for i in range(1, num_chunks):
+            f.seek(boundaries[0] + (size - boundaries[0]) * i // num_chunks)
+            f.readline()
+            if boundaries[-1] < f.tell() < size:
+                boundaries.append(f.tell())
+    boundaries.append(size)
+
+    quotes = pool.map(_count_quotes, [(file, start, end) for start, end in zip(boundaries[:-1], boundaries[1:])])
+    starts = [boundaries[0]]
+    for boundary, quotes_before in zip(boundaries[1:-1], np.cumsum(quotes).tolist()):
+        if quotes_before % 2 == 0:
+            starts.append(boundary)
+    return header, list(zip(starts, starts[1:] + [size]))
+
+def _csvread_parallel(file, usecols, workers):
+    # parse newline aligned byte ranges of the file in worker processes and
+    # concatenate their columns in file order
+    num_chunks = min(workers, os.path.getsize(file) // MIN_CSV_CHUNK)
+    with multiprocessing.Pool(workers) as pool:
+        header, ranges = _csv_ranges(file, num_chunks, pool)
+        names = next(csv.reader([header.decode('utf-8-sig')]))
+        frames = pool.map(_parse_csv_range, [(file, start, end, names, usecols) for start, end in ranges])
+
+    columns = {}
+    for column in frames[0].columns:
+        parts = [frame[column] for frame in frames]
+        if isinstance(parts[0].dtype, pd.CategoricalDtype):
+            # categories differ between chunks, the codes are remapped to the union
+            columns[column] = pd.Series(pd.api.types.union_categoricals(parts))
+        else:
+            columns[column] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(columns)
+
+def csvread_columns(file, usecols=None, cache=False, workers=1):
+    # read a csv file with header into a dict of typed numpy arrays (one per column)
+    # usecols optionally selects columns, missing columns are ignored
+    # with cache the parsed columns are stored as .npy files next to the csv and
+    # reused (memory mapped) until the size or modification time of the csv changes
+    # with workers > 1 large files are parsed in chunks by a pool of processes
+    if not file:
+        return None
+
+    if cache:
+        cache_dir = _cache_dir(file, usecols)
+        data = _load_column_cache(file, cache_dir)
+        if data is not None:
+            return data
+
+    if workers > 1 and os.path.getsize(file) >= 2 * MIN_CSV_CHUNK:
+        data = _csvread_parallel(file, usecols, workers)
+    else:
+        data = _read_csv(file, usecols)
+
+    if cache:
+        try:
+            _save_column_cache(file, cache_dir, data)
+        except OSError as e:
+            print('could not write csv cache for {}: {}'.format(file, e))
+
+    return {column: data[column].to_numpy() for column in data.columns}
+
 def csvwrite(data, file):
     with open(file, 'w', encoding='utf-8') as f:
         writer = csv.writer(f)
         for d in data:
             writer.writerow(d)
 
-def _url_to_license(licenses, mode='http'):
-    # create dict with license urls as 
-    # mode is either http or https
-    
-    # create dict
-    licenses_by_url = {}
+def write_coco_json(dataset, file, compact=False, chunk_size=1000):
+    # write a coco style dict into a .json file (.json.gz is compressed)
+    # list and generator values are written a chunk of records at a time
+    # so they never have to be encoded in one piece
+    separators = (',', ':') if compact else (', ', ': ')
+    item_separator, key_separator = separators
+    encoder = json.JSONEncoder(separators=separators)
 
-    for license in licenses:
-        # Get URL
-        if mode == 'https':
-            url = 'https:' + license['url'][5:]
-        else:
-            url = license['url']
-        # Add to dict
-        licenses_by_url[url] = license
-        
-    return licenses_by_url
+    with _open_text(file, 'w') as f:
+        f.write('{')
+        for i, (key, value) in enumerate(dataset.items()):
+            if i > 0:
+                f.write(item_separator)
+            f.write(encoder.encode(key) + key_separator)
+            if isinstance(value, (dict, str)) or not isinstance(value, Iterable):
+                f.write(encoder.encode(value))
+                continue
+            f.write('[')
+            records = iter(value)
+            first = True
+            while True:
+                chunk = [encoder.encode(record) for record in islice(records, chunk_size)]
+                if not chunk:
+                    break
+                if not first:
+                    f.write(item_separator)
+                f.write(item_separator.join(chunk))
+                first = False
+            f.write(']')
+        f.write('}')
+
+def write_coco_shards(dataset, file, shard_size, compact=False):
+    # split a coco style dict into json files of shard_size images each
+    # every shard is a valid coco file holding a contiguous block of images and their annotations
+    # annotations have to be grouped by image in the order of dataset['images']
+    # an index file maps every image_id to its shard
+    images = dataset['images']
+    annotations = iter(dataset['annotations'])
+    num_shards = max(1, -(-len(images) // shard_size))
+
+    base, extension = file[:-len('.json.gz')], '.json.gz'
+    if not file.endswith('.json.gz'):
+        base, extension = os.path.splitext(file)
+
+    next_annotation = [next(annotations, None)]
+    def shard_annotations(shard_image_ids):
+        # take annotations from the shared iterator until one belongs to a later shard
+        while next_annotation[0] is not None and next_annotation[0]['image_id'] in shard_image_ids:
+            yield next_annotation[0]
+            next_annotation[0] = next(annotations, None)
+
+    index = {'num_images': len(images), 'shard_size': shard_size, 'shards': [], 'image_to_shard': {}}
+    for shard in range(num_shards):
+        shard_images = images[shard * shard_size:(shard + 1) * shard_size]
+        shard_image_ids = {img['id'] for img in shard_images}
+        shard_file = '{}-{:05d}-of-{:05d}{}'.format(base, shard, num_shards, extension)
+
+        shard_dataset = dict(dataset)
+        shard_dataset['images'] = shard_images
+        shard_dataset['annotations'] = shard_annotations(shard_image_ids)
+        write_coco_json(shard_dataset, shard_file, compact=compact)
+
+        index['shards'].append({'file': os.path.basename(shard_file), 'num_images': len(shard_images)})
+        for img in shard_images:
+            index['image_to_shard'][img['id']] = shard
+
+    if next_annotation[0] is not None:
+        raise ValueError('annotations are not grouped in image order, image {} is out of place'.format(next_annotation[0]['image_id']))
+
+    with open(base + '_index.json', 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+
+def write_annotation_store(directory, original_annotations, images, categories, start_index=0):
+    # write bbox annotations into the columnar store read by annotation_store.AnnotationStore
+    # images are sorted by id and every image owns a contiguous range of annotation rows
+    columns = _convert_instance_columns(original_annotations, images, categories)
+    attributes = [attr for attr in annotation_store.ATTRIBUTES if attr in original_annotations]
+
+    image_ids = np.array([img['id'] for img in images])
+    image_order = np.argsort(image_ids, kind='stable')
+    image_rank = np.empty_like(image_order)
+    image_rank[image_order] = np.arange(len(image_order))
+
+    # annotation rows ordered by the sorted position of their image, csv order within an image
+    rank = image_rank[columns['image_index']]
+    rows = np.argsort(rank, kind='stable')
+    offsets = np.zeros(len(images) + 1, dtype='int64')
+    np.cumsum(np.bincount(rank, minlength=len(images)), out=offsets[1:])
+
+    flags, flags_unknown = annotation_store.pack_flags({attr: original_annotations[attr][rows] for attr in attributes})
+
+    os.makedirs(directory, exist_ok=True)
+    arrays = {'image_ids': image_ids[image_order],
+              'image_sizes': np.array([[img['width'], img['height']] for img in images], dtype='int32').reshape(-1, 2)[image_order],
+              'offsets': offsets,
+              'annotation_ids': (rows + start_index).astype('int64'),
+              'boxes': columns['bbox'][rows].astype('float32'),
+              'areas': columns['area'][rows].astype('float32'),
+              'category_ids': columns['category_id'][rows].astype('int16'),
+              'flags': flags,
+              'flags_unknown': flags_unknown}
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, name + '.npy'), array)
+    # meta.json is written last and marks the store as complete
+    with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'categories': categories,
+                   'attributes': attributes,
+                   'num_images': len(images),
+                   'num_annotations': len(rows)}, f)
+
+def image_sizes_to_dict(original_image_sizes):
+    # size csv columns to a dict image_id -> [width, height]
+    if not original_image_sizes:
+        return {}
+    return {image_id: [w, h] for image_id, w, h in zip(original_image_sizes['image_id'].tolist(),
+                                                        original_image_sizes['image_w'].tolist(),
+                                                        original_image_sizes['image_h'].tolist())}
+
+def probe_image_sizes(image_ids, image_dir, size_file=None, num_threads=32):
+    # read width and height from the headers of image_dir/<image_id>.jpg
+    # the reads are issued from a thread pool since they mostly wait for the filesystem
+    # results are appended to size_file (image_id,image_w,image_h) for later runs
+    def probe(image_id):
+        return imagesize.get(os.path.join(image_dir, image_id + '.jpg'))
+
+    image_size_dict = {}
+    with ThreadPoolExecutor(num_threads) as executor:
+        for image_id, (width, height) in tqdm(zip(image_ids, executor.map(probe, image_ids)),
+                                              total=len(image_ids), desc='Reading image sizes ', mininterval=0.5):
+            image_size_dict[image_id] = [width, height]
+
+    if size_file:
+        write_header = not os.path.isfile(size_file) or os.path.getsize(size_file) == 0
+        with open(size_file, 'a', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            if write_header:
+                writer.writerow(['image_id', 'image_w', 'image_h'])
+            for image_id, (width, height) in image_size_dict.items():
+                # unreadable images are probed again next time
+                if width > 0 and height > 0:
+                    writer.writerow([image_id, width, height])
+
+    return image_size_dict
+
+class _JsonStream:
+    # incremental reader for large json files, decodes one value at a time
+    # from a buffer that is refilled in chunks
+
+    _whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, f, chunk_size=2**22):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        # drop consumed text and append the next chunk, returns False at the end of the file
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+        return bool(chunk)
+
+    def peek(self):
+        # next non whitespace character or '' at the end of the file
+        while True:
+            self.pos = self._whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, characters):
+        character = self.peek()
+        if character == '' or character not in characters:
+            raise ValueError('expected one of {!r} at offset {} but found {!r}'.format(characters, self.pos, character))
+        self.pos += 1
+        return character
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number cut by the end of the buffer may continue in the next chunk
+                complete = end < len(self.buffer) and (not isinstance(value, (int, float)) or self.buffer[end] in ',]}: \t\n\r')
+                if complete or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def array(self):
+        # yield the elements of the array starting at the current position
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+    def object_keys(self):
+        # yield the keys of the object starting at the current position
+        # the value of each key has to be consumed (value() or array()) before the next key
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+def _open_text(file, mode='r'):
+    # plain or gzip compressed (.gz) text file
+    if file.endswith('.gz'):
+        return gzip.open(file, mode + 't', encoding='utf-8', compresslevel=6)
+    return open(file, mode, encoding='utf-8')
+
+def iter_json_array(file):
+    # yield the elements of a file holding a json array without loading all of it
+    with _open_text(file) as f:
+        yield from _JsonStream(f).array()
+
+def iter_coco_sections(file, chunk_size=100000):
+    # yield (key, value) for the top level entries of a coco json file (.json or .json.gz)
+    # images and annotations are yielded in chunks (lists) of at most chunk_size items
+    # so that files with millions of annotations never have to be loaded at once
+    with _open_text(file) as f:
+        stream = _JsonStream(f)
+        for key in stream.object_keys():
+            if key in ('images', 'annotations'):
+                items = stream.array()
+                for chunk in iter(lambda: list(islice(items, chunk_size)), []):
+                    yield key, chunk
+            else:
+                yield key, stream.value()
+
+def _normalize_url(url):
+    # http and https urls of the same license map to the same key
+    return url.split('://', 1)[-1]
+
+def _url_to_license(licenses):
+    # create dict with normalized license urls as keys
+    return {_normalize_url(license['url']): license for license in licenses}
 
 def _list_to_dict(list_data):
     
@@ -68,138 +514,262 @@ def convert_category_annotations(orginal_category_info):
     
     return categories
 
+def _group_rows(groups, values, num_groups):
+    # list of values per group, values keep their row order within a group
+    order = np.argsort(groups, kind='stable')
+    offsets = np.zeros(num_groups + 1, dtype='int64')
+    np.cumsum(np.bincount(groups, minlength=num_groups), out=offsets[1:])
+    values = values[order].tolist()
+    offsets = offsets.tolist()
+    return [values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+def _build_images(original_image_metadata, original_image_annotations, image_ids, widths, heights, categories, licenses, origin_info):
+    # image level labels are grouped by image in one sorted pass
+    # labels of images without metadata are ignored
+    image_index = pd.Index(image_ids).drop_duplicates()
+    cat_index = pd.Index([cat['freebase_id'] for cat in categories])
+    cat_ids = np.array([cat['id'] for cat in categories], dtype='int64')
+    label_cat_ids = cat_ids[_lookup(cat_index, original_image_annotations['LabelName'], 'LabelName')]
+    label_images = image_index.get_indexer(original_image_annotations['ImageID'])
+    confidence = np.asarray(original_image_annotations['Confidence'])
+    positive = (label_images >= 0) & (confidence == 1)
+    negative = (label_images >= 0) & (confidence == 0)
+    pos_img_lvl_anns = _group_rows(label_images[positive], label_cat_ids[positive], len(image_index))
+    neg_img_lvl_anns = _group_rows(label_images[negative], label_cat_ids[negative], len(image_index))
+    image_groups = image_index.get_indexer(image_ids).tolist()
+
+    if origin_info:
+        # look up license ids once per distinct license url
+        licenses_by_url = _url_to_license(licenses)
+        license_codes, license_urls = pd.factorize(np.asarray(original_image_metadata['License'], dtype=object))
+        license_ids = np.array([licenses_by_url[_normalize_url(url)]['id'] for url in license_urls], dtype='int64')
+        images = [{'id': key,
+                   'file_name': key + '.jpg',
+                   'neg_category_ids': neg_img_lvl_anns[group],
+                   'pos_category_ids': pos_img_lvl_anns[group],
+                   'original_url': original_url,
+                   'license': license_id,
+                   'width': width,
+                   'height': height}
+                  for key, group, original_url, license_id, width, height in zip(
+                      image_ids,
+                      image_groups,
+                      original_image_metadata['OriginalURL'].tolist(),
+                      license_ids[license_codes].tolist(),
+                      widths.tolist(),
+                      heights.tolist())]
+    else:
+        images = [{'id': key,
+                   'file_name': key + '.jpg',
+                   'neg_category_ids': neg_img_lvl_anns[group],
+                   'pos_category_ids': pos_img_lvl_anns[group],
+                   'width': width,
+                   'height': height}
+                  for key, group, width, height in zip(image_ids, image_groups, widths.tolist(), heights.tolist())]
+
+    return images
+
 def convert_image_annotations(original_image_metadata,
                               original_image_annotations,
                               original_image_sizes,
                               image_dir,
                               categories,
                               licenses,
-                              origin_info=False):
-    
-    original_image_metadata_dict = _list_to_dict(original_image_metadata)
-    original_image_annotations_dict = _list_to_dict(original_image_annotations)
-    
-    cats_by_freebase_id = {cat['freebase_id']: cat for cat in categories}
+                              origin_info=False,
+                              size_file=None):
     
+    image_ids = original_image_metadata['ImageID'].tolist()
+
+    # look up sizes in the size csv, the last entry of an image wins
+    widths = np.full(len(image_ids), -1, dtype='int64')
+    heights = np.full(len(image_ids), -1, dtype='int64')
     if original_image_sizes:
-        image_size_dict = {x[0]:  [int(x[1]), int(x[2])] for x in original_image_sizes[1:]}
+        size_ids = pd.Index(original_image_sizes['image_id'])
+        unique_sizes = ~size_ids.duplicated(keep='last')
+        size_pos = size_ids[unique_sizes].get_indexer(image_ids)
+        found = size_pos >= 0
+        widths[found] = np.asarray(original_image_sizes['image_w'])[unique_sizes][size_pos[found]]
+        heights[found] = np.asarray(original_image_sizes['image_h'])[unique_sizes][size_pos[found]]
+        missing = np.flatnonzero(~found).tolist()
     else:
-        image_size_dict = {}
-    
-    # Get dict with license urls
-    licenses_by_url_http = _url_to_license(licenses, mode='http')
-    licenses_by_url_https = _url_to_license(licenses, mode='https')
-    
-    # convert original image annotations to dicts
-    pos_img_lvl_anns = defaultdict(list)
-    neg_img_lvl_anns = defaultdict(list)
-    for ann in original_image_annotations_dict[1:]:
-        cat_of_ann = cats_by_freebase_id[ann['LabelName']]['id']
-        if int(ann['Confidence']) == 1:
-            pos_img_lvl_anns[ann['ImageID']].append(cat_of_ann)
-        elif int(ann['Confidence']) == 0:
-            neg_img_lvl_anns[ann['ImageID']].append(cat_of_ann)
+        missing = list(range(len(image_ids)))
+
+    # read the sizes of images missing from the size csv from their headers
+    if missing:
+        probed = probe_image_sizes([image_ids[i] for i in missing], image_dir, size_file=size_file)
+        widths[missing], heights[missing] = np.array([probed[image_ids[i]] for i in missing], dtype='int64').T
     
-    #Create list
-    images = []
-
-    # loop through entries skipping title line
-    num_images = len(original_image_metadata_dict)
-    for i in tqdm(range(num_images), mininterval=0.5):
-        # Select image ID as key
-        key = original_image_metadata_dict[i]['ImageID']
-        
-        # Copy information
-        img = {}
-        img['id'] = key
-        img['file_name'] = key + '.jpg'
-        img['neg_category_ids'] = neg_img_lvl_anns.get(key, [])
-        img['pos_category_ids'] = pos_img_lvl_anns.get(key, [])
-        if origin_info:
-            img['original_url'] = original_image_metadata_dict[i]['OriginalURL']
-            license_url = original_image_metadata_dict[i]['License']
-            # Look up license id
-            try:
-                img['license'] = licenses_by_url_https[license_url]['id']
-            except:
-                img['license'] = licenses_by_url_http[license_url]['id']
-
-        # Extract height and width
-        image_size = image_size_dict.get(key, None)
-        if image_size is not None:
-            img['width'], img['height'] = image_size
-        else:
-            filename = os.path.join(image_dir, img['file_name'])
-            img['width'], img['height'] = imagesize.get(filename)
-            
-        # Add to list of images
-        images.append(img)
+    # the cyclic garbage collector is paused while the lists and dicts are built, see convert_instance_annotations
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        images = _build_images(original_image_metadata, original_image_annotations, image_ids, widths, heights, categories, licenses, origin_info)
+    finally:
+        if gc_enabled:
+            gc.enable()
         
     return images
 
 
-def convert_instance_annotations(original_annotations, images, categories, start_index=0):
-    
-    original_annotations_dict = _list_to_dict(original_annotations)
-    
-    imgs = {img['id']: img for img in images}
-    cats = {cat['id']: cat for cat in categories}
-    cats_by_freebase_id = {cat['freebase_id']: cat for cat in categories}
-    
-    annotations = []
+def _round(values, decimals=2):
+    # vectorized version of python's round(x, decimals) with identical results
+    # numpy rounds x * 10**decimals which can differ from python's correctly
+    # rounded result close to ties, those few values are rounded in python
+    values = np.asarray(values, dtype='float64')
+    rounded = np.round(values, decimals)
+    scaled = values * 10**decimals
+    close_to_tie = np.nonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-4)
+    rounded[close_to_tie] = [round(v, decimals) for v in values[close_to_tie].tolist()]
+    return rounded
+
+def _lookup(index, keys, name):
+    # map keys to positions in a pandas index, raising like a dict lookup
+    positions = index.get_indexer(keys)
+    missing = np.flatnonzero(positions < 0)
+    if len(missing):
+        raise KeyError('{} not found: {}'.format(name, keys[missing[0]]))
+    return positions
+
+def _convert_instance_columns(original_annotations, images, categories):
+    # compute pixel boxes, areas and category ids for all instances at once
+    # image_index refers to positions in images, the last image of a duplicated id wins
+    image_ids = pd.Index([img['id'] for img in images])
+    unique_images = np.flatnonzero(~image_ids.duplicated(keep='last'))
+    widths = np.array([img['width'] for img in images], dtype='float64')
+    heights = np.array([img['height'] for img in images], dtype='float64')
+    cat_index = pd.Index([cat['freebase_id'] for cat in categories])
+    cat_ids = np.array([cat['id'] for cat in categories], dtype='int64')
+
+    img_pos = unique_images[_lookup(image_ids[unique_images], original_annotations['ImageID'], 'ImageID')]
+    cat_pos = _lookup(cat_index, original_annotations['LabelName'], 'LabelName')
+
+    width = widths[img_pos]
+    height = heights[img_pos]
+    xmin = original_annotations['XMin'] * width
+    ymin = original_annotations['YMin'] * height
+    xmax = original_annotations['XMax'] * width
+    ymax = original_annotations['YMax'] * height
+    dx = xmax - xmin
+    dy = ymax - ymin
+
+    columns = {}
+    columns['image_index'] = img_pos
+    columns['category_id'] = cat_ids[cat_pos]
+    columns['bbox'] = _round(np.stack([xmin, ymin, dx, dy], axis=1))
+    columns['area'] = _round(dx * dy)
+    return columns
+
+def iter_instance_annotations(original_annotations, images, categories, start_index=0, chunk_size=100000, sort_by_image=False):
+    # generator version of convert_instance_annotations
+    for chunk in iter_instance_annotation_chunks(original_annotations, images, categories, start_index, chunk_size, sort_by_image):
+        yield from chunk
+
+def iter_instance_annotation_chunks(original_annotations, images, categories, start_index=0, chunk_size=100000, sort_by_image=False):
+    # yields the annotations of iter_instance_annotations in lists of chunk_size
+    # boxes are computed for all instances at once but dicts are built chunk by chunk
+    # with sort_by_image the annotations are grouped by image in the order of images,
+    # ids still follow the csv rows
     
-    annotated_attributes = [attr for attr in ['IsOccluded', 'IsTruncated', 'IsGroupOf', 'IsDepiction', 'IsInside'] if attr in original_annotations[0]]
-
-    num_instances = len(original_annotations_dict)
-    for i in tqdm(range(num_instances), mininterval=0.5):
-        # set individual instance id
-        # use start_index to separate indices between dataset splits
-        key = i + start_index
-        csv_line = i
-        ann = {}
-        ann['id'] = key
-        image_id = original_annotations_dict[csv_line]['ImageID']
-        ann['image_id'] = image_id
-        ann['freebase_id'] = original_annotations_dict[csv_line]['LabelName']
-        ann['category_id'] = cats_by_freebase_id[ann['freebase_id']]['id']
-        ann['iscrowd'] = False
-        
-        xmin = float(original_annotations_dict[csv_line]['XMin']) * imgs[image_id]['width']
-        ymin = float(original_annotations_dict[csv_line]['YMin']) * imgs[image_id]['height']
-        xmax = float(original_annotations_dict[csv_line]['XMax']) * imgs[image_id]['width']
-        ymax = float(original_annotations_dict[csv_line]['YMax']) * imgs[image_id]['height']
-        dx = xmax - xmin
-        dy = ymax - ymin
-        ann['bbox'] = [round(a, 2) for a in [xmin , ymin, dx, dy]]
-        ann['area'] = round(dx * dy, 2)
-        
-        for attribute in annotated_attributes:
-            ann[attribute.lower()] = int(original_annotations_dict[csv_line][attribute])
+    annotated_attributes = [attr for attr in ['IsOccluded', 'IsTruncated', 'IsGroupOf', 'IsDepiction', 'IsInside'] if attr in original_annotations]
+
+    columns = _convert_instance_columns(original_annotations, images, categories)
+
+    num_instances = len(columns['area'])
+    order = np.argsort(columns['image_index'], kind='stable') if sort_by_image else None
+    with tqdm(total=num_instances, mininterval=0.5) as pbar:
+        for start in range(0, num_instances, chunk_size):
+            end = min(start + chunk_size, num_instances)
+            if order is None:
+                rows = slice(start, end)
+                ids = range(start + start_index, end + start_index)
+            else:
+                rows = order[start:end]
+                ids = (rows + start_index).tolist()
+            # only the dicts are built per row, all values come from the columns
+            # use start_index to separate indices between dataset splits
+            chunk = [{'id': key,
+                      'image_id': image_id,
+                      'freebase_id': freebase_id,
+                      'category_id': category_id,
+                      'iscrowd': False,
+                      'bbox': bbox,
+                      'area': area}
+                     for key, image_id, freebase_id, category_id, bbox, area in zip(
+                         ids,
+                         original_annotations['ImageID'][rows].tolist(),
+                         original_annotations['LabelName'][rows].tolist(),
+                         columns['category_id'][rows].tolist(),
+                         columns['bbox'][rows].tolist(),
+                         columns['area'][rows].tolist())]
+            for attribute in annotated_attributes:
+                key = attribute.lower()
+                for ann, value in zip(chunk, original_annotations[attribute][rows].tolist()):
+                    ann[key] = value
+            pbar.update(end - start)
+            yield chunk
 
-        annotations.append(ann)
+def convert_instance_annotations(original_annotations, images, categories, start_index=0):
+
+    # the cyclic garbage collector repeatedly scans the growing list of dicts
+    # none of them form cycles so it is paused while building
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        annotations = list(iter_instance_annotations(original_annotations, images, categories, start_index))
+    finally:
+        if gc_enabled:
+            gc.enable()
         
     return annotations
 
 
-def _id_to_rgb(array):
-    B = array // 256**2
-    rest = array % 256**2
-    G = rest // 256
-    R = rest % 256
-    return np.stack([R, G, B], axis=-1).astype('uint8')
+def _id_to_rgb(array, out=None):
+    # panoptic colors of segment ids, id = R + 256 * G + 256**2 * B
+    # the low three bytes of the little endian ids are copied into out (uint8, shape + (3,))
+    ids = np.ascontiguousarray(array, dtype='<u4')
+    if out is None:
+        out = np.empty(ids.shape + (3,), dtype='uint8')
+    np.copyto(out, ids.view('uint8').reshape(ids.shape + (4,))[..., :3])
+    return out
 
 def _get_mask_file(segment, mask_dir):
     name = "{}_{}_{}.png".format(
         segment["ImageID"], segment["LabelName"].replace('/',''), segment["BoxID"])
     return os.path.join(mask_dir, name)
 
-def _combine_small_on_top(masks):
-    combined = np.zeros(shape=masks[0].shape, dtype='uint32')
-    sizes = [np.sum(m != 0) for m in masks]
-    for idx in np.argsort(sizes)[::-1]:
-        mask = masks[idx]
-        combined[mask != 0] = mask[mask != 0]
-    return combined
+def _png_size(file):
+    # width and height from the IHDR chunk, without decoding the image
+    with open(file, 'rb') as f:
+        header = f.read(24)
+    if header[:8] != png_writer.PNG_SIGNATURE or header[12:16] != b'IHDR':
+        raise ValueError('{} is not a png file'.format(file))
+    return struct.unpack('>II', header[16:24])
+
+def _load_mask(file, size):
+    # decode a mask png into (bbox, crop, area) or None if the mask is empty
+    # bbox (x0, y0, x1, y1) encloses the non zero pixels and crop is the boolean mask inside it,
+    # so only the part of the mask that is set is converted into an array
+    # masks that are not of size (width, height) are scaled to it
+    with Image.open(file) as mask:
+        if mask.size != size:
+            mask = mask.resize(size, Image.NEAREST)
+        bbox = mask.getbbox()
+        if bbox is None:
+            return None
+        crop = np.asarray(mask.crop(bbox)) != 0
+    return bbox, crop, np.count_nonzero(crop)
+
+def _combine_small_on_top(masks, shape):
+    # masks are (bbox, crop, area) from _load_mask, smaller masks are painted on top of larger ones
+    # pixels hold the position in masks + 1 (0 is void) in the smallest dtype that fits
+    # returns the index image and the number of visible pixels per index
+    areas = [area for _, _, area in masks]
+    combined = np.zeros(shape=shape, dtype=np.min_scalar_type(len(masks)))
+    for idx in np.argsort(areas, kind='stable')[::-1].tolist():
+        (x0, y0, x1, y1), crop, _ = masks[idx]
+        np.copyto(combined[y0:y1, x0:x1], idx + 1, where=crop)
+    pixel_counts = np.bincount(combined.ravel(), minlength=len(masks) + 1)
+    return combined, pixel_counts
 
 def _greedy_combine(masks):
     combined = np.zeros(shape=masks[0].shape, dtype='uint32')
@@ -208,96 +778,333 @@ def _greedy_combine(masks):
     return combined
 
 
-def convert_segmentation_annotations(original_segmentations, images, categories, original_mask_dir, segmentation_out_dir, start_index=0):
+def _convert_segmentation_image(task):
+    # combine the masks of one image into a panoptic png and return its annotation
+    # runs in worker processes, segment ids are assigned before dispatch
+    img, segments, original_mask_dir, segmentation_out_dir, writer = task
+
+    ann = dict()
+    ann['file_name'] = img['file_name']
+    ann['image_id'] = img['id']
+    ann['segments_info'] = []
+    masks = []
+    segment_ids = []
+    empty_segment_ids = []
+    # the output has the size of the first mask, read from its png header
+    mask_files = [_get_mask_file(segment, original_mask_dir) for segment in segments]
+    width, height = _png_size(mask_files[0])
+    for segment, mask_file in zip(segments, mask_files):
+        # collect mask
+        mask = _load_mask(mask_file, (width, height))
+        # exclude empty masks
+        if mask is None:
+            empty_segment_ids.append(segment["SegmentID"])
+            continue
+        masks.append(mask)
+        segment_ids.append(segment["SegmentID"])
+
+        # collect segment info
+        segment_info = {}
+        # Compute bbox coordinates
+        xmin = float(segment['BoxXMin']) * img['width']
+        ymin = float(segment['BoxYMin']) * img['height']
+        xmax = float(segment['BoxXMax']) * img['width']
+        ymax = float(segment['BoxYMax']) * img['height']
+        dx = xmax - xmin
+        dy = ymax - ymin
+        # Fill in annotations
+        segment_info['bbox'] = [round(a, 2) for a in [xmin , ymin, dx, dy]]
+        segment_info['area'] = round(dx * dy, 2)
+        segment_info['category_id'] = segment['category_id']
+        # the id has to match the pixel value in the panoptic png
+        segment_info['id'] = segment["SegmentID"]
+        # append
+        ann['segments_info'].append(segment_info)
+
+    if not masks:
+        print("No non-empty masks in image {}".format(ann['image_id']))
+        return None
+
+    # Looks like many masks overlap
+    # currently managed by greedy combining
+    combined_index_mask, pixel_counts = _combine_small_on_top(masks, (height, width))
+    # check if masks overlap. If they do we have a problem
+    # every segment, including empty ones, has to be visible in the output
+    hidden_segment_ids = [segment_id for segment_id, count in zip(segment_ids, pixel_counts[1:].tolist()) if count == 0]
+    if hidden_segment_ids or empty_segment_ids:
+        print("Overlapping masks in image {}".format(ann['image_id']))
+        print("Not in pixel values: {}".format(sorted(empty_segment_ids + hidden_segment_ids)))
+        # don't include the annotation into the output
+        return None
+
+    # map the position in masks to the color of its segment id, directly into the rgb buffer
+    colors = _id_to_rgb(np.array([0] + segment_ids, dtype='uint32'))
+    combined_rgb_mask = np.take(colors, combined_index_mask, axis=0, out=writer.buffer((height, width)))
+    out_file = os.path.join(segmentation_out_dir, "{}.png".format(ann['image_id']))
+    writer.write(out_file, combined_rgb_mask)
+
+    return ann
+
+
+def _read_manifest(manifest_file):
+    # load the per image entries written by iter_segmentation_annotations
+    # a line cut off by a crash is ignored, the image is simply converted again
+    entries = {}
+    if not os.path.isfile(manifest_file):
+        return entries
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            entries[entry['image_id']] = entry
+    return entries
+
+def _is_finished(entry):
+    # images dropped because of overlapping masks have no output file
+    if entry is None:
+        return False
+    return entry['out_file'] is None or os.path.isfile(entry['out_file'])
+
+
+def iter_segmentation_annotations(original_segmentations, images, categories, original_mask_dir, segmentation_out_dir, start_index=0, workers=1, manifest_file=None, resume=False, writer=None):
 
     original_segmentations_dict = _list_to_dict(original_segmentations)
     
     if not os.path.isdir(segmentation_out_dir):
         os.mkdir(segmentation_out_dir)
 
-    image_ids = list(np.unique([ann['ImageID'] for ann in original_segmentations_dict]))
+    image_ids = {ann['ImageID'] for ann in original_segmentations_dict}
     filtered_images = [img for img in images if img['id'] in image_ids]
 
-    imgs = {img['id']: img for img in filtered_images}
-    cats = {cat['id']: cat for cat in categories}
     cats_by_freebase_id = {cat['freebase_id']: cat for cat in categories}
 
+    # segment ids are fixed by the csv row so they do not depend on
+    # which worker converts an image or in which order
+    # use start_index to separate indices between dataset splits
     for i in range(len(original_segmentations_dict)):
-        original_segmentations_dict[i]["SegmentID"] = i + 1
+        original_segmentations_dict[i]["SegmentID"] = i + 1 + start_index
+        original_segmentations_dict[i]["category_id"] = cats_by_freebase_id[original_segmentations_dict[i]['LabelName']]['id']
 
     img_segment_map = defaultdict(list)
     for segment in original_segmentations_dict:
         img_segment_map[segment["ImageID"]].append(segment)
 
-    annotations = []
-    segment_index = 0 + start_index
-    for img in tqdm(filtered_images, mininterval=0.5):
-        ann = dict()
-        ann['file_name'] = img['file_name']
-        ann['image_id'] = img['id']
-        ann['segments_info'] = []
-        masks = []
-        for segment in img_segment_map[img['id']]:
-            # collect mask
-            mask_file = _get_mask_file(segment, original_mask_dir)
-            mask = io.imread(mask_file)# load png
-            # exclude empty masks
-            if np.max(mask) == 0:
-                continue
-            mask = mask // 255 # set to [0,1]
-            mask = mask * segment["SegmentID"]
-            masks.append(mask)
-
-            # collect segment info
-            segment_info = {}
-            # Compute bbox coordinates
-            xmin = float(segment['BoxXMin']) * img['width']
-            ymin = float(segment['BoxYMin']) * img['height']
-            xmax = float(segment['BoxXMax']) * img['width']
-            ymax = float(segment['BoxYMax']) * img['height']
-            dx = xmax - xmin
-            dy = ymax - ymin
-            # Fill in annotations
-            segment_info['bbox'] = [round(a, 2) for a in [xmin , ymin, dx, dy]]
-            segment_info['area'] = round(dx * dy, 2)
-            segment_info['category_id'] = cats_by_freebase_id[segment['LabelName']],
-            segment_info['id'] = segment_index
-            segment_index += 1 
-            # append
-            ann['segments_info'].append(segment_info)
+    # every converted image is recorded in the manifest
+    # on resume, images with a recorded and existing output are not converted again
+    if manifest_file is None:
+        manifest_file = os.path.join(segmentation_out_dir, 'manifest.jsonl')
+    finished = _read_manifest(manifest_file) if resume else {}
+    finished = {image_id: entry for image_id, entry in finished.items() if _is_finished(entry)}
+    pending = [img for img in filtered_images if img['id'] not in finished]
+    if resume:
+        print('resuming: {} of {} images already converted'.format(len(filtered_images) - len(pending), len(filtered_images)))
 
-        
-        # combined_binary_mask = sum(masks)
-        # Looks like many masks overlap
-        # currently managed by greedy combining
-        combined_binary_mask = _combine_small_on_top(masks)
-        # check if masks overlap. If they do we have a problem
-        ids_in_mask = len(np.unique(combined_binary_mask[combined_binary_mask != 0]))
-        num_segments = len(img_segment_map[img['id']])
-        if ids_in_mask != num_segments:
-            print("Overlapping masks in image {}".format(ann['image_id']))
-            values_in_output = np.unique(combined_binary_mask[combined_binary_mask != 0])
-            ids_in_segments = [segment["SegmentID"] for segment in img_segment_map[img['id']]]
-            not_in_segments = [x for x in values_in_output if x not in ids_in_segments]
-            not_in_values = [x for x in ids_in_segments if x not in values_in_output]
-            print("Not in segments: {}".format(not_in_segments))
-            print("Not in pixel values: {}".format(not_in_values))
-            # don't include the annotation into the output
-            continue
+    # pngs are written with writer (a png_writer.PngWriter), in worker processes always synchronously
+    if writer is None:
+        writer = png_writer.PngWriter()
+    tasks = ((img, img_segment_map[img['id']], original_mask_dir, segmentation_out_dir, writer) for img in pending)
 
-        combined_rgb_mask = _id_to_rgb(combined_binary_mask)
-        out_file = os.path.join(segmentation_out_dir, "{}.png".format(ann['image_id']))
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            io.imsave(out_file, combined_rgb_mask)
-    
-        annotations.append(ann)
-        
-    return annotations
+    with open(manifest_file, 'a' if resume else 'w', encoding='utf-8') as manifest:
+        # start on a fresh line if the previous run stopped in the middle of one
+        if manifest.tell() > 0:
+            manifest.write('\n')
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
+        try:
+            if pool is not None:
+                # results come back in image order, each worker writes its own pngs
+                results = pool.imap(_convert_segmentation_image, tasks, chunksize=16)
+            else:
+                results = map(_convert_segmentation_image, tasks)
+
+            for img in tqdm(filtered_images, mininterval=0.5):
+                if img['id'] in finished:
+                    ann = finished[img['id']]['annotation']
+                else:
+                    ann = next(results)
+                    entry = {'image_id': img['id'],
+                             'out_file': os.path.join(segmentation_out_dir, "{}.png".format(img['id'])) if ann else None,
+                             'annotation': ann}
+                    manifest.write(json.dumps(entry) + '\n')
+                    manifest.flush()
+                if ann is not None:
+                    yield ann
+
+            # let the workers exit normally so their output is flushed
+            if pool is not None:
+                pool.close()
+                pool.join()
+        finally:
+            if pool is not None:
+                pool.terminate()
+            writer.close()
+
+
+def convert_segmentation_annotations(original_segmentations, images, categories, original_mask_dir, segmentation_out_dir, start_index=0, workers=1, manifest_file=None, resume=False, writer=None):
+    return list(iter_segmentation_annotations(original_segmentations, images, categories, original_mask_dir, segmentation_out_dir, start_index, workers, manifest_file, resume, writer))
 
 
 def filter_images(images, annotations):
-    image_ids = list(np.unique([ann['image_id'] for ann in annotations]))
+    image_ids = {ann['image_id'] for ann in annotations}
     filtered_images = [img for img in images if img['id'] in image_ids]
     return filtered_images
     
+
+
+class PredictionsNotGrouped(Exception):
+    pass
+
+def _prediction_string(pred, image_size_dict):
+    # one detection in the Open Images PredictionString format
+    image_width, image_height = image_size_dict[pred['image_id']]
+    xmin = pred['bbox'][0] / image_width
+    ymin = pred['bbox'][1] / image_height
+    xmax = xmin + pred['bbox'][2] / image_width
+    ymax = ymin + pred['bbox'][3] / image_height
+    return f"{pred['category_id']} {pred['score']:.4f} {xmin:.4f} {ymin:.4f} {xmax:.4f} {ymax:.4f}"
+
+# '{:.4f}' of k / 10000 for every k in [0, 10000]
+_FIXED4_STRINGS = np.array(['{:.4f}'.format(k / 10000) for k in range(10001)], dtype=object)
+
+def _format_fixed4(values):
+    # '{:.4f}'.format for a whole array, values in [0, 1] are looked up in a table
+    # negative, larger, non finite and values close to a rounding tie are formatted in python
+    scaled = values * 10000
+    rounded = np.rint(scaled)
+    with np.errstate(invalid='ignore'):
+        fallback = np.signbit(values) | ~(rounded <= 10000) | (np.abs(scaled - np.floor(scaled) - 0.5) < 1e-4)
+    strings = _FIXED4_STRINGS[np.where(fallback, 0, rounded).astype(np.intp)]
+    fallback = np.flatnonzero(fallback)
+    strings[fallback] = ['{:.4f}'.format(value) for value in values[fallback].tolist()]
+    return strings.tolist()
+
+def convert_prediction_strings(predictions, image_size_dict, image_ids):
+    # batched conversion of coco style detections into [ImageId, PredictionString] rows
+    # boxes are normalized as arrays and detections are grouped per image by a stable sort
+    # rows follow image_ids, images without detections get an empty string
+    codes, pred_image_ids = pd.factorize(np.array([pred['image_id'] for pred in predictions], dtype=object))
+    pred_image_ids = pred_image_ids.tolist()
+    image_sizes = np.array([image_size_dict[image_id] for image_id in pred_image_ids], dtype='float64').reshape(-1, 2)
+    bbox = np.array([pred['bbox'] for pred in predictions], dtype='float64').reshape(-1, 4)
+    scores = np.array([pred['score'] for pred in predictions], dtype='float64')
+    cat_codes, cats = pd.factorize(np.array([pred['category_id'] for pred in predictions], dtype=object))
+
+    image_width = image_sizes[codes, 0]
+    image_height = image_sizes[codes, 1]
+    xmin = bbox[:, 0] / image_width
+    ymin = bbox[:, 1] / image_height
+    xmax = xmin + bbox[:, 2] / image_width
+    ymax = ymin + bbox[:, 3] / image_height
+
+    # format every column at once, then join the columns of each detection
+    order = np.argsort(codes, kind='stable')
+    cat_strings = np.array([str(cat) for cat in cats], dtype=object)[cat_codes[order]].tolist()
+    results = list(map(' '.join, zip(cat_strings,
+                                     _format_fixed4(scores[order]),
+                                     _format_fixed4(xmin[order]),
+                                     _format_fixed4(ymin[order]),
+                                     _format_fixed4(xmax[order]),
+                                     _format_fixed4(ymax[order]))))
+    ends = np.cumsum(np.bincount(codes, minlength=len(pred_image_ids))).tolist()
+    starts = [0] + ends[:-1]
+    prediction_strings = {image_id: ' '.join(results[start:end]) for image_id, start, end in zip(pred_image_ids, starts, ends)}
+
+    return [[image_id, prediction_strings.get(image_id, '')] for image_id in image_ids]
+
+def iter_grouped_prediction_strings(predictions, image_size_dict):
+    # yield (image_id, PredictionString) as soon as the predictions of an image end
+    # requires the predictions of every image to be contiguous, otherwise
+    # PredictionsNotGrouped is raised when an image shows up a second time
+    finished = set()
+    current_image_id = None
+    results = []
+    for pred in predictions:
+        image_id = pred['image_id']
+        if image_id != current_image_id:
+            if current_image_id is not None:
+                yield current_image_id, ' '.join(results)
+                finished.add(current_image_id)
+            if image_id in finished:
+                raise PredictionsNotGrouped(image_id)
+            current_image_id = image_id
+            results = []
+        results.append(_prediction_string(pred, image_size_dict))
+    if current_image_id is not None:
+        yield current_image_id, ' '.join(results)
+
+def iter_spilled_prediction_strings(predictions, image_size_dict, spill_dir, num_buckets=64):
+    # external grouping for predictions in any order
+    # converted detections are spilled into bucket files by a hash of the image id,
+    # afterwards every bucket is small enough to be grouped in memory
+    bucket_files = [os.path.join(spill_dir, 'bucket-{:05d}.tsv'.format(i)) for i in range(num_buckets)]
+    buckets = [open(bucket_file, 'w', encoding='utf-8') for bucket_file in bucket_files]
+    try:
+        for pred in predictions:
+            image_id = pred['image_id']
+            bucket = zlib.crc32(image_id.encode('utf-8')) % num_buckets
+            buckets[bucket].write('{}\t{}\n'.format(image_id, _prediction_string(pred, image_size_dict)))
+    finally:
+        for bucket in buckets:
+            bucket.close()
+
+    for bucket_file in bucket_files:
+        img_pred_map = defaultdict(list)
+        with open(bucket_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                image_id, result = line.rstrip('\n').split('\t')
+                img_pred_map[image_id].append(result)
+        os.remove(bucket_file)
+        for image_id, results in img_pred_map.items():
+            yield image_id, ' '.join(results)
+
+def _category_label_names(categories, category_ids):
+    # freebase ids (LabelName) of coco category ids, categories without one keep their name
+    cat_index = pd.Index([cat['id'] for cat in categories])
+    label_names = np.array([cat.get('freebase_id', cat['name']) for cat in categories], dtype=object)
+    return label_names[_lookup(cat_index, category_ids, 'category_id')]
+
+def convert_coco_image_labels(images, categories):
+    # Open Images image level label columns for a chunk of coco images
+    # per image the positive labels (Confidence 1) come before the negative ones (Confidence 0)
+    pos = [img.get('pos_category_ids', []) for img in images]
+    neg = [img.get('neg_category_ids', []) for img in images]
+    counts = np.array([[len(p), len(n)] for p, n in zip(pos, neg)], dtype='int64').reshape(-1, 2)
+    num_rows = int(counts.sum())
+    category_ids = np.fromiter(chain.from_iterable(chain.from_iterable(zip(pos, neg))), dtype='int64', count=num_rows)
+
+    columns = {}
+    columns['ImageID'] = np.repeat(np.array([img['id'] for img in images], dtype=object), counts.sum(axis=1))
+    columns['LabelName'] = _category_label_names(categories, category_ids)
+    columns['Confidence'] = np.repeat(np.tile(np.array([1, 0], dtype='int8'), len(images)), counts.ravel())
+    return columns
+
+def convert_coco_instances(annotations, image_index, image_widths, image_heights, categories):
+    # Open Images bbox columns for a chunk of coco bbox annotations
+    # image_index, image_widths and image_heights describe all images the annotations refer to
+    # boxes are normalized by the image size, clipped to [0, 1] and rounded to 6 decimals
+    # all attribute columns are written so that every chunk has the same columns,
+    # attributes an annotation does not have are -1 (unknown)
+    if annotations and 'bbox' not in annotations[0]:
+        raise ValueError('only bbox annotations can be converted, annotation {} has no bbox'.format(annotations[0].get('id')))
+    image_ids = np.array([ann['image_id'] for ann in annotations], dtype=object)
+    img_pos = _lookup(image_index, image_ids, 'image_id')
+    bbox = np.array([ann['bbox'] for ann in annotations], dtype='float64').reshape(-1, 4)
+    width = image_widths[img_pos]
+    height = image_heights[img_pos]
+
+    def normalize(values, size):
+        return np.round(np.clip(values / size, 0, 1), 6)
+
+    columns = {}
+    columns['ImageID'] = image_ids
+    columns['LabelName'] = _category_label_names(categories, np.array([ann['category_id'] for ann in annotations], dtype='int64'))
+    columns['Confidence'] = np.ones(len(annotations), dtype='int8')
+    columns['XMin'] = normalize(bbox[:, 0], width)
+    columns['XMax'] = normalize(bbox[:, 0] + bbox[:, 2], width)
+    columns['YMin'] = normalize(bbox[:, 1], height)
+    columns['YMax'] = normalize(bbox[:, 1] + bbox[:, 3], height)
+    for attribute in annotation_store.ATTRIBUTES:
+        key = attribute.lower()
+        columns[attribute] = np.array([ann.get(key, -1) for ann in annotations], dtype='int8')
+    return columns